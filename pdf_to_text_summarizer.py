@@ -1,110 +1,413 @@
 #!/usr/bin/env python3
 import PyPDF2
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import mmap
+import os
 import re
+import sys
 import textwrap
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-def extract_text_from_pdf(pdf_path):
+import numpy as np
+
+# Versión del formato de la caché; cambiarla invalida las entradas anteriores
+CACHE_VERSION = 2
+
+# Encabezados de capítulo (CAPÍTULO n, SECCIÓN n, "1. Título", "IV. Título")
+# en una sola expresión anclada al inicio de línea; sirve para str y bytes
+CHAPTER_PATTERN = (
+    r'^[^\S\n]*(?:'
+    r'(?i:(?:CAP(?:Í|í|I)TULO|CAP\.?)[^\S\n]*(?:\d+|[IVX]+))'
+    r'|(?i:SECCI(?:Ó|ó|O)N[^\S\n]*(?:\d+|[IVX]+))'
+    r'|\d+\.[^\S\n]+[A-Z]'
+    r'|[IVX]+\.[^\S\n]+[A-Z]'
+    r')[^\n]*'
+)
+CHAPTER_RE = re.compile(CHAPTER_PATTERN, re.M)
+CHAPTER_RE_BYTES = re.compile(CHAPTER_PATTERN.encode("utf-8"), re.M)
+
+SUMMARY_KEYWORDS = ('objetivo', 'importante', 'principal', 'conclusión', 'resultado',
+                    'propósito', 'guía', 'modelo', 'agua', 'subterránea')
+WHITESPACE_RE = re.compile(r'\s+')
+SENTENCE_END_RE = re.compile(r'[.!?]+')
+WORD_RE = re.compile(r'\w+')
+
+# Lector del PDF abierto una vez por proceso del pool
+_worker_reader = None
+
+def _open_pdf_in_worker(pdf_path):
+    """Abre el PDF al iniciar cada proceso del pool"""
+    global _worker_reader
+    _worker_reader = PyPDF2.PdfReader(pdf_path)
+
+def _extract_page_range(page_range):
+    """Extrae el texto de un rango de páginas [inicio, fin)"""
+    start, end = page_range
+    return [_worker_reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+def iter_pdf_pages(pdf_path, workers=None, pages_per_task=16):
+    """Genera (número de página, texto) en orden, extrayendo en paralelo.
+
+    Los rangos de páginas se reparten en un pool de procesos; como mucho
+    2 * workers rangos están en curso a la vez, así que la memoria no crece
+    con el tamaño del documento.
+    """
+    num_pages = len(PyPDF2.PdfReader(pdf_path).pages)
+    ranges = [(start, min(start + pages_per_task, num_pages)) for start in range(0, num_pages, pages_per_task)]
+    workers = min(workers or os.cpu_count() or 1, max(len(ranges), 1))
+
+    if workers == 1:
+        _open_pdf_in_worker(pdf_path)
+        for start, end in ranges:
+            for offset, text in enumerate(_extract_page_range((start, end))):
+                yield start + offset, text
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_open_pdf_in_worker, initargs=(pdf_path,)) as executor:
+        remaining = iter(ranges)
+        pending = deque(
+            (page_range[0], executor.submit(_extract_page_range, page_range))
+            for page_range in itertools.islice(remaining, workers * 2)
+        )
+
+        while pending:
+            start, future = pending.popleft()
+            texts = future.result()
+
+            next_range = next(remaining, None)
+            if next_range is not None:
+                pending.append((next_range[0], executor.submit(_extract_page_range, next_range)))
+
+            for offset, text in enumerate(texts):
+                yield start + offset, text
+
+def write_pdf_text(pdf_path, output_path, workers=None):
+    """Escribe el texto del PDF en output_path a medida que se extrae.
+
+    Devuelve la posición (en bytes UTF-8) de cada página dentro del archivo.
+    """
+    offsets = []
+    position = 0
+    with open(output_path, "wb") as f:
+        for page_num, text in iter_pdf_pages(pdf_path, workers):
+            data = text.encode("utf-8")
+            f.write(data)
+            offsets.append({"page": page_num + 1, "start": position, "end": position + len(data)})
+            position += len(data)
+    return offsets
+
+def extract_text_from_pdf(pdf_path, workers=None):
     """Extrae texto de un archivo PDF"""
-    text = ""
-    with open(pdf_path, 'rb') as file:
-        pdf_reader = PyPDF2.PdfReader(file)
-        for page_num in range(len(pdf_reader.pages)):
-            page = pdf_reader.pages[page_num]
-            text += page.extract_text()
-    return text
+    return "".join(text for _, text in iter_pdf_pages(pdf_path, workers))
 
 def find_chapters(text):
-    """Encuentra capítulos en el texto basándose en patrones comunes"""
-    # Patrones comunes para capítulos
-    chapter_patterns = [
-        r'(?i)(?:CAPÍTULO|CAPITULO|CAP\.?)\s*(\d+|[IVX]+)',
-        r'(?i)(?:SECCIÓN|SECCION)\s*(\d+|[IVX]+)',
-        r'^\d+\.\s+[A-Z]',
-        r'^[IVX]+\.\s+[A-Z]'
-    ]
-    
-    chapters = []
-    lines = text.split('\n')
-    
-    for i, line in enumerate(lines):
-        for pattern in chapter_patterns:
-            if re.match(pattern, line.strip()):
-                chapters.append((i, line.strip()))
-                break
-    
-    return chapters
+    """Encuentra capítulos en el texto basándose en patrones comunes.
+
+    Devuelve (posición de inicio de la línea, título) en una sola pasada.
+    """
+    return [(match.start(), match.group().strip()) for match in CHAPTER_RE.finditer(text)]
 
 def split_into_chapters(text, chapter_markers):
     """Divide el texto en capítulos basándose en los marcadores encontrados"""
-    chapters = {}
-    lines = text.split('\n')
-    
     if not chapter_markers:
         # Si no se encuentran capítulos, trata todo como un solo capítulo
         return {"Documento Completo": text}
-    
-    for i, (line_num, chapter_title) in enumerate(chapter_markers):
-        start = line_num
-        end = chapter_markers[i+1][0] if i+1 < len(chapter_markers) else len(lines)
-        
-        chapter_text = '\n'.join(lines[start:end])
-        chapters[chapter_title] = chapter_text
-    
+
+    chapters = {}
+    for i, (start, chapter_title) in enumerate(chapter_markers):
+        end = chapter_markers[i+1][0] if i+1 < len(chapter_markers) else len(text)
+        chapter_text = text[start:end]
+        chapters[chapter_title] = chapter_text[:-1] if chapter_text.endswith('\n') else chapter_text
+
     return chapters
 
+def split_chapters_file(path):
+    """Divide en capítulos un archivo de texto UTF-8 sin cargarlo entero.
+
+    El archivo se mapea en memoria y los encabezados se buscan en una sola
+    pasada sobre los bytes; solo se decodifica el texto de cada capítulo.
+    """
+    if os.path.getsize(path) == 0:
+        return {"Documento Completo": ""}
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        markers = [(match.start(), match.group()) for match in CHAPTER_RE_BYTES.finditer(data)]
+        if not markers:
+            return {"Documento Completo": data[:].decode("utf-8")}
+
+        chapters = {}
+        for i, (start, title) in enumerate(markers):
+            end = markers[i+1][0] if i+1 < len(markers) else len(data)
+            chapter_text = data[start:end].decode("utf-8")
+            chapters[title.decode("utf-8").strip()] = chapter_text[:-1] if chapter_text.endswith('\n') else chapter_text
+
+    return chapters
+
+def _split_sentences(text):
+    """Divide un texto en oraciones de más de 20 caracteres"""
+    text = WHITESPACE_RE.sub(' ', text).strip()
+    sentences = (s.strip() for s in SENTENCE_END_RE.split(text))
+    return [s for s in sentences if len(s) > 20]
+
+def summarize_chapters(texts, max_sentences=5, keyword_weight=1.0, batch_size=64):
+    """Crea un resumen extractivo de cada texto, procesando los textos por lotes.
+
+    Cada oración recibe el promedio de la frecuencia relativa de sus palabras
+    dentro de su texto, más un bono por cada palabra clave. Todo el puntaje
+    se calcula con operaciones vectorizadas sobre las palabras del lote; el
+    conteo usa np.unique, que ordena, así que cuesta O(n log n) en el número
+    de palabras. Se eligen las mejores oraciones y se conserva su orden.
+    """
+    summaries = []
+
+    for batch_start in range(0, len(texts), batch_size):
+        batch = [_split_sentences(text) for text in texts[batch_start:batch_start + batch_size]]
+
+        vocabulary = {}
+        token_ids, token_text, token_sentence = [], [], []
+        sentence_text = [0]
+        sentence_count = 0
+        for text_idx, sentences in enumerate(batch):
+            for sentence in sentences:
+                for word in WORD_RE.findall(sentence.lower()):
+                    token_ids.append(vocabulary.setdefault(word, len(vocabulary)))
+                    token_text.append(text_idx)
+                    token_sentence.append(sentence_count)
+                sentence_count += 1
+            sentence_text.append(sentence_count)
+
+        scores = np.zeros(sentence_count)
+        if token_ids:
+            token_ids = np.array(token_ids)
+            token_text = np.array(token_text)
+            token_sentence = np.array(token_sentence)
+
+            # Frecuencia de cada palabra dentro de su propio texto
+            _, inverse, counts = np.unique(
+                token_text * len(vocabulary) + token_ids, return_inverse=True, return_counts=True
+            )
+            words_per_text = np.bincount(token_text, minlength=len(batch))
+            token_scores = counts[inverse] / words_per_text[token_text]
+
+            is_keyword = np.array([word.startswith(SUMMARY_KEYWORDS) for word in vocabulary])
+            token_scores = token_scores + keyword_weight * is_keyword[token_ids]
+
+            totals = np.bincount(token_sentence, weights=token_scores, minlength=sentence_count)
+            lengths = np.bincount(token_sentence, minlength=sentence_count)
+            scores = np.divide(totals, lengths, out=np.zeros(sentence_count), where=lengths > 0)
+
+        for text_idx, sentences in enumerate(batch):
+            text_scores = scores[sentence_text[text_idx]:sentence_text[text_idx + 1]]
+            if len(sentences) > max_sentences:
+                # Las mejores oraciones, en su orden original
+                chosen = np.sort(np.argpartition(-text_scores, max_sentences - 1)[:max_sentences])
+            else:
+                chosen = range(len(sentences))
+            summaries.append('. '.join(sentences[i] for i in chosen) + '.')
+
+    return summaries
+
 def summarize_text(text, max_sentences=5):
     """Crea un resumen básico del texto"""
-    # Limpia el texto
-    text = re.sub(r'\s+', ' ', text).strip()
-    
-    # Divide en oraciones
-    sentences = re.split(r'[.!?]+', text)
-    sentences = [s.strip() for s in sentences if len(s.strip()) > 20]
-    
-    # Toma las primeras oraciones más relevantes
-    summary_sentences = []
-    for sentence in sentences[:max_sentences * 2]:
-        # Prioriza oraciones que contengan palabras clave
-        keywords = ['objetivo', 'importante', 'principal', 'conclusión', 'resultado', 
-                   'propósito', 'guía', 'modelo', 'agua', 'subterránea']
-        if any(keyword in sentence.lower() for keyword in keywords) and len(summary_sentences) < max_sentences:
-            summary_sentences.append(sentence)
-    
-    # Si no hay suficientes oraciones con palabras clave, completa con las primeras
-    while len(summary_sentences) < max_sentences and len(sentences) > len(summary_sentences):
-        for sentence in sentences:
-            if sentence not in summary_sentences:
-                summary_sentences.append(sentence)
-                break
-    
-    return '. '.join(summary_sentences[:max_sentences]) + '.'
+    return summarize_chapters([text], max_sentences)[0]
+
+def file_sha256(path, chunk_size=1 << 20):
+    """Calcula el hash SHA-256 del contenido de un archivo"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def process_pdf(pdf_path, cache_dir, content_hash=None):
+    """Extrae y divide en capítulos un PDF, usando la caché si su contenido no cambió"""
+    content_hash = content_hash or file_sha256(pdf_path)
+    cache_file = os.path.join(cache_dir, f"{content_hash}.json")
+
+    cached = os.path.exists(cache_file)
+    if cached:
+        with open(cache_file, encoding="utf-8") as f:
+            chapters = json.load(f)["chapters"]
+    else:
+        # Un proceso por archivo: la extracción de cada PDF es secuencial
+        text = extract_text_from_pdf(pdf_path, workers=1)
+        chapters = [
+            {"title": title, "text": chapter_text}
+            for title, chapter_text in split_into_chapters(text, find_chapters(text)).items()
+        ]
+
+        # Escritura atómica para no dejar entradas a medias en la caché
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"version": CACHE_VERSION, "content_hash": content_hash, "chapters": chapters}, f)
+        os.replace(tmp_file, cache_file)
+
+    stat = os.stat(pdf_path)
+    return {
+        "file": pdf_path,
+        "content_hash": content_hash,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "cache_file": cache_file,
+        "chapters": [chapter["title"] for chapter in chapters],
+        "cached": cached
+    }
+
+def process_corpus(input_dir, output_dir, workers=None):
+    """Procesa en paralelo todos los PDF de un directorio y escribe un manifiesto.
+
+    El texto extraído y los capítulos se guardan en la caché con el hash del
+    contenido como clave, así que los PDF sin cambios no se vuelven a procesar.
+    """
+    cache_dir = os.path.join(output_dir, f"cache_v{CACHE_VERSION}")
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, "manifest.json")
+
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            previous = {entry["file"]: entry for entry in json.load(f)["files"]}
+
+    pdf_files = sorted(
+        os.path.join(input_dir, name)
+        for name in os.listdir(input_dir)
+        if name.lower().endswith(".pdf")
+    )
+
+    # Si tamaño y fecha no cambiaron, se reutiliza el hash sin leer el archivo
+    known_hashes = []
+    for pdf_path in pdf_files:
+        stat = os.stat(pdf_path)
+        entry = previous.get(pdf_path)
+        unchanged = (
+            entry is not None
+            and entry["size"] == stat.st_size
+            and entry["mtime_ns"] == stat.st_mtime_ns
+            and os.path.exists(entry["cache_file"])
+        )
+        known_hashes.append(entry["content_hash"] if unchanged else None)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        entries = list(executor.map(
+            process_pdf, pdf_files, itertools.repeat(cache_dir), known_hashes
+        ))
+
+    for entry in entries:
+        previous_entry = previous.get(entry["file"], {})
+        entry["ingested"] = (
+            previous_entry.get("ingested", False)
+            and previous_entry.get("content_hash") == entry["content_hash"]
+        )
+
+    manifest = {"version": CACHE_VERSION, "input_dir": input_dir, "files": entries}
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+    print(f"{len(entries)} PDF procesados ({sum(entry['cached'] for entry in entries)} desde la caché)")
+    return manifest
+
+async def ingest_corpus(manifest, manifest_path, db_config, collection="default"):
+    """Agrega los capítulos de los PDF nuevos o modificados a PostgresRAG"""
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "rag-postgresql"))
+    from postgres_rag import PostgresRAG
+
+    # Solo se necesita el modelo de embeddings, no el LLM
+    rag = PostgresRAG(
+        db_config=db_config,
+        embedding_model_name=os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2"),
+        load_llm=False
+    )
+    await rag.connect()
+    try:
+        for entry in manifest["files"]:
+            if entry["ingested"]:
+                continue
+
+            with open(entry["cache_file"], encoding="utf-8") as f:
+                chapters = json.load(f)["chapters"]
+
+            source_file = os.path.basename(entry["file"])
+            documents = [
+                {
+                    "id": f"{entry['content_hash'][:16]}:{index}",
+                    "content": chapter["text"],
+                    "metadata": {
+                        "source_file": source_file,
+                        "content_hash": entry["content_hash"],
+                        "chapter": chapter["title"],
+                        "chapter_index": index
+                    }
+                }
+                for index, chapter in enumerate(chapters)
+            ]
+            # Reemplaza en una sola transacción los capítulos de una versión
+            # anterior del mismo archivo
+            _, chunks = await rag.replace_documents(
+                {"source_file": source_file}, documents, collection=collection
+            )
+            print(f"{source_file}: {len(documents)} capítulos, {chunks} fragmentos agregados")
+
+            # Guarda el progreso después de cada archivo
+            entry["ingested"] = True
+            with open(manifest_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2, ensure_ascii=False)
+    finally:
+        await rag.close()
+
+def run_batch(args):
+    """Modo por lotes: procesa un directorio de PDF y opcionalmente lo ingesta"""
+    manifest = process_corpus(args.batch, args.output, args.workers)
+
+    if args.ingest:
+        db_config = {
+            "host": os.getenv("DB_HOST", "localhost"),
+            "port": int(os.getenv("DB_PORT", 5432)),
+            "user": os.getenv("DB_USER", "raguser"),
+            "password": os.getenv("DB_PASSWORD", "ragpass"),
+            "database": os.getenv("DB_NAME", "ragdb")
+        }
+        manifest_path = os.path.join(args.output, "manifest.json")
+        asyncio.run(ingest_corpus(manifest, manifest_path, db_config, args.collection))
+
+def parse_args():
+    """Argumentos de línea de comandos"""
+    parser = argparse.ArgumentParser(description="Extrae y resume documentos PDF")
+    parser.add_argument("--batch", metavar="DIR", help="Procesa todos los PDF de un directorio")
+    parser.add_argument("--output", default="corpus_salida", help="Directorio de caché y manifiesto")
+    parser.add_argument("--workers", type=int, default=None, help="Número de procesos")
+    parser.add_argument("--ingest", action="store_true", help="Agrega los capítulos a PostgresRAG")
+    parser.add_argument("--collection", default="default", help="Colección de PostgresRAG")
+    return parser.parse_args()
 
 def main():
     pdf_file = "Guia_uso_modelo_aguas_subterraneas_seia.pdf"
     
     print(f"Extrayendo texto de {pdf_file}...")
-    text = extract_text_from_pdf(pdf_file)
-    
-    # Guarda el texto completo
-    with open("texto_completo.txt", "w", encoding="utf-8") as f:
-        f.write(text)
-    print("Texto completo guardado en 'texto_completo.txt'")
+    # Guarda el texto completo página a página, junto con la posición de cada página
+    offsets = write_pdf_text(pdf_file, "texto_completo.txt")
+    with open("texto_completo_paginas.json", "w", encoding="utf-8") as f:
+        json.dump(offsets, f)
+    print(f"Texto completo guardado en 'texto_completo.txt' ({len(offsets)} páginas)")
     
     # Encuentra capítulos
     print("\nBuscando capítulos...")
-    chapter_markers = find_chapters(text)
-    chapters = split_into_chapters(text, chapter_markers)
+    chapters = split_chapters_file("texto_completo.txt")
     
     # Genera resúmenes
     print(f"\nGenerando resúmenes de {len(chapters)} secciones...")
+    summaries = summarize_chapters(list(chapters.values()))
     
     with open("resumen_por_capitulos.md", "w", encoding="utf-8") as f:
         f.write("# Resumen del documento: Guía uso modelo aguas subterráneas SEIA\n\n")
         
-        for chapter_title, chapter_text in chapters.items():
+        for chapter_title, summary in zip(chapters, summaries):
             f.write(f"## {chapter_title}\n\n")
             
-            summary = summarize_text(chapter_text)
             # Formatea el resumen
             wrapped_summary = textwrap.fill(summary, width=80)
             f.write(f"{wrapped_summary}\n\n")
@@ -113,4 +416,8 @@ def main():
     print("Resumen guardado en 'resumen_por_capitulos.md'")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    if args.batch:
+        run_batch(args)
+    else:
+        main()
\ No newline at end of file
@@ -6,20 +6,61 @@ import asyncio
 import os
 from datetime import datetime
 import logging
-from prometheus_client import Counter, Histogram, generate_latest
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
 from fastapi.responses import PlainTextResponse
 
-from postgres_rag import PostgresRAG
+from postgres_rag import PostgresRAG, StageOverloaded, DEFAULT_ADMISSION
+from storage import NumpyVectorStore
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Prometheus metrics
+# Prometheus metrics. With API_WORKERS > 1, set PROMETHEUS_MULTIPROC_DIR
+# (prometheus_client multiprocess mode) so that /metrics adds up every
+# worker; without it a scrape only sees the worker that answered it.
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+METRICS_REFRESH_SECONDS = 5
 query_counter = Counter('rag_queries_total', 'Total number of RAG queries')
 query_duration = Histogram('rag_query_duration_seconds', 'RAG query duration')
 document_counter = Counter('rag_documents_added_total', 'Total documents added')
 
+# Counters kept by the RAG engine itself
+ENGINE_METRICS = {
+    'prefill_tokens_saved': 'Prompt tokens served from the prefix KV cache',
+    'coalesced_searches': 'Searches served by an identical in-flight search',
+    'coalesced_queries': 'Queries served by an identical in-flight query',
+    'reembedded_rows': 'Chunks re-embedded by the online re-embedding job'
+}
+engine_gauges = {
+    metric_name: Gauge(f'rag_{metric_name}', description, multiprocess_mode='sum')
+    for metric_name, description in ENGINE_METRICS.items()
+}
+
+# Admission control
+stage_rejections = Counter('rag_stage_rejections_total', 'Requests shed by admission control', ['stage', 'reason'])
+degraded_counter = Counter('rag_degraded_responses_total', 'Queries answered with retrieval-only results')
+stage_queue_depth = Gauge(
+    'rag_stage_queue_depth', 'Requests waiting for a stage slot', ['stage'], multiprocess_mode='livesum'
+)
+stage_active = Gauge('rag_stage_active', 'Requests running in a stage', ['stage'], multiprocess_mode='livesum')
+
+def refresh_engine_gauges():
+    """Copy this process's engine counters and stage occupancy into the gauges"""
+    if rag_system is None:
+        return
+    for metric_name, gauge in engine_gauges.items():
+        gauge.set(rag_system.metrics[metric_name])
+    for stage_name, limiter in rag_system.limiters.items():
+        stage_queue_depth.labels(stage_name).set(limiter.waiting)
+        stage_active.labels(stage_name).set(limiter.active)
+
+async def refresh_engine_gauges_periodically():
+    """Keep this worker's gauges current for scrapes answered by other workers"""
+    while True:
+        refresh_engine_gauges()
+        await asyncio.sleep(METRICS_REFRESH_SECONDS)
+
 # Initialize FastAPI app
 app = FastAPI(
     title="PostgreSQL RAG API",
@@ -38,6 +79,8 @@ app.add_middleware(
 
 # Global RAG instance
 rag_system = None
+warmup_task = None
+metrics_task = None
 
 # Pydantic models
 class Document(BaseModel):
@@ -47,44 +90,159 @@ class Document(BaseModel):
 
 class DocumentBatch(BaseModel):
     documents: List[Document] = Field(..., description="List of documents to add")
+    collection: str = Field("default", description="Collection to add the documents to")
 
 class Query(BaseModel):
     question: str = Field(..., description="Question to ask")
     top_k: int = Field(5, description="Number of documents to retrieve")
     metadata_filter: Optional[Dict] = Field(None, description="Metadata filter for search")
+    collection: Optional[str] = Field("default", description="Collection to search (null searches all)")
+
+class FilteredIndexRequest(BaseModel):
+    metadata_filter: Dict = Field(..., description="Hot metadata filter to index")
+    lists: Optional[int] = Field(None, description="IVFFlat lists for the partial index (sized from matching rows if omitted)")
+    collection: str = Field("default", description="Collection whose partition gets the index")
+
+class Collection(BaseModel):
+    name: str = Field(..., description="Collection name (lowercase letters, digits, underscores)")
+    lists: int = Field(100, description="Number of IVFFlat lists for the collection index")
+
+class IndexRebuild(BaseModel):
+    lists: Optional[int] = Field(None, description="IVFFlat lists (sized from row count if omitted)")
+
+class ReembedRequest(BaseModel):
+    embedding_model: str = Field(..., description="Embedding model to re-embed all chunks with")
+    batch_size: int = Field(256, description="Chunks embedded and written per batch")
+    max_rows_per_second: Optional[float] = Field(None, description="Throttle (unlimited if omitted)")
 
 class SearchQuery(BaseModel):
     query: str = Field(..., description="Search query")
     top_k: int = Field(5, description="Number of results to return")
     metadata_filter: Optional[Dict] = Field(None, description="Metadata filter")
+    collection: Optional[str] = Field("default", description="Collection to search (null searches all)")
 
-# API endpoints
-@app.on_event("startup")
-async def startup_event():
-    """Initialize RAG system on startup"""
-    global rag_system
-    
-    db_config = {
+def parse_replicas(value: str) -> List[Dict]:
+    """Parse DB_REPLICAS ("host[:port],host[:port]") into replica configs"""
+    replicas = []
+    for entry in filter(None, (part.strip() for part in value.split(','))):
+        host, _, port = entry.partition(':')
+        replicas.append({'host': host, 'port': int(port or 5432)})
+    return replicas
+
+def db_config_from_env() -> Dict:
+    """Database settings from the DB_* environment variables"""
+    return {
         'host': os.getenv('DB_HOST', 'localhost'),
         'port': int(os.getenv('DB_PORT', 5432)),
         'user': os.getenv('DB_USER', 'raguser'),
         'password': os.getenv('DB_PASSWORD', 'ragpass'),
-        'database': os.getenv('DB_NAME', 'ragdb')
+        'database': os.getenv('DB_NAME', 'ragdb'),
+        'replicas': parse_replicas(os.getenv('DB_REPLICAS', '')),
+        'read_routing': os.getenv('DB_READ_ROUTING', 'round_robin'),
+        'read_pool_min_size': int(os.getenv('DB_READ_POOL_MIN_SIZE', 10)),
+        'read_pool_max_size': int(os.getenv('DB_READ_POOL_MAX_SIZE', 20)),
+        'write_pool_min_size': int(os.getenv('DB_WRITE_POOL_MIN_SIZE', 2)),
+        'write_pool_max_size': int(os.getenv('DB_WRITE_POOL_MAX_SIZE', 10)),
+        'acquire_timeout': float(os.getenv('DB_ACQUIRE_TIMEOUT', 10)),
+        'command_timeout': float(os.getenv('DB_COMMAND_TIMEOUT', 60))
     }
+
+async def resolve_embedding_model() -> str:
+    """The model the stored vectors come from, or EMBEDDING_MODEL if none is recorded"""
+    configured = os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+    if os.getenv('STORAGE_BACKEND', 'postgres') == 'numpy':
+        return configured
+    return await PostgresRAG.read_active_model(db_config_from_env()) or configured
+
+def build_rag_system(embedding_model_name: Optional[str] = None) -> PostgresRAG:
+    """Load the RAG system (models included) from environment configuration"""
+    # STORAGE_BACKEND=numpy keeps everything in process (one worker only),
+    # persisted to STORAGE_PATH on shutdown when set
+    embedding_model_name = embedding_model_name or os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+    storage = None
+    if os.getenv('STORAGE_BACKEND', 'postgres') == 'numpy':
+        storage = NumpyVectorStore(os.getenv('STORAGE_PATH') or None, embedding_model_name)
     
-    rag_system = PostgresRAG(
-        db_config=db_config,
-        embedding_model_name=os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2'),
+    return PostgresRAG(
+        db_config=db_config_from_env(),
+        embedding_model_name=embedding_model_name,
         llm_model_name=os.getenv('LLM_MODEL', 'gpt2'),
-        use_cache=True
+        use_cache=True,
+        inference_backend=os.getenv('INFERENCE_BACKEND', 'torch'),
+        num_threads=int(os.getenv('INFERENCE_THREADS', 0)) or None,
+        num_interop_threads=int(os.getenv('INFERENCE_INTEROP_THREADS', 0)) or None,
+        admission=admission_from_env(),
+        degrade_on_overload=os.getenv('DEGRADE_ON_OVERLOAD', '').lower() in ('1', 'true', 'yes'),
+        storage=storage
+    )
+
+def admission_from_env() -> Dict[str, Dict]:
+    """Stage limits from <STAGE>_MAX_CONCURRENCY / _MAX_QUEUE / _QUEUE_TIMEOUT"""
+    admission = {}
+    for stage, defaults in DEFAULT_ADMISSION.items():
+        prefix = stage.upper()
+        admission[stage] = {
+            'max_concurrency': int(os.getenv(f'{prefix}_MAX_CONCURRENCY', defaults['max_concurrency'])),
+            'max_queue': int(os.getenv(f'{prefix}_MAX_QUEUE', defaults['max_queue'])),
+            'queue_timeout': float(os.getenv(f'{prefix}_QUEUE_TIMEOUT', defaults['queue_timeout']))
+        }
+    return admission
+
+def warmup_from_env() -> Dict:
+    """Warm-up settings from WARMUP_* variables (WARMUP_TOP_N=0 disables it)"""
+    return {
+        'top_n': int(os.getenv('WARMUP_TOP_N', 200)),
+        'sample_searches': int(os.getenv('WARMUP_SEARCHES', 20)),
+        'since_hours': int(os.getenv('WARMUP_SINCE_HOURS', 24)),
+        'budget': float(os.getenv('WARMUP_BUDGET', 30)),
+        'prewarm_indexes': os.getenv('WARMUP_PREWARM', '').lower() in ('1', 'true', 'yes')
+    }
+
+def overloaded(e: StageOverloaded) -> HTTPException:
+    """429 when the stage queue is full, 503 when the wait deadline passed"""
+    stage_rejections.labels(e.stage, e.reason).inc()
+    return HTTPException(
+        status_code=429 if e.reason == 'queue_full' else 503,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)}
     )
+
+def check_inference_parity():
+    """Refuse to serve if the quantized/exported encoder drifts from fp32"""
+    min_cosine = os.getenv('INFERENCE_PARITY_MIN_COSINE')
+    if min_cosine:
+        parity = rag_system.check_embedding_parity(min_cosine=float(min_cosine))
+        if not parity['passed']:
+            raise RuntimeError(f"Embedding parity check failed: {parity}")
+
+# API endpoints
+@app.on_event("startup")
+async def startup_event():
+    """Initialize RAG system on startup"""
+    global rag_system, warmup_task, metrics_task
     
+    # Pre-fork workers inherit the models loaded (and checked) by the parent process
+    if rag_system is None:
+        rag_system = build_rag_system(await resolve_embedding_model())
+        check_inference_parity()
+    
+    if PROMETHEUS_MULTIPROC_DIR:
+        metrics_task = asyncio.ensure_future(refresh_engine_gauges_periodically())
+    
+    # Each process (and each pre-fork worker) opens its own pools
     await rag_system.connect()
     logger.info("RAG system initialized successfully")
+    
+    # Warm the caches in the background; /ready answers 503 until it is done
+    warmup_task = asyncio.ensure_future(rag_system.warm_up(**warmup_from_env()))
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cleanup on shutdown"""
+    if warmup_task:
+        warmup_task.cancel()
+    if metrics_task:
+        metrics_task.cancel()
     if rag_system:
         await rag_system.close()
 
@@ -110,6 +268,13 @@ async def health_check():
     except Exception as e:
         raise HTTPException(status_code=503, detail=str(e))
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness endpoint: 503 until the cache warm-up has finished"""
+    if not rag_system or not rag_system.ready:
+        raise HTTPException(status_code=503, detail="Warming up")
+    return {"status": "ready", "warmup": rag_system.warmup_stats}
+
 @app.post("/documents")
 async def add_documents(
     batch: DocumentBatch,
@@ -123,7 +288,7 @@ async def add_documents(
         docs = [doc.dict() for doc in batch.documents]
         
         # Add documents
-        chunks_added = await rag_system.add_documents(docs)
+        chunks_added = await rag_system.add_documents(docs, collection=batch.collection)
         
         return {
             "status": "success",
@@ -142,7 +307,8 @@ async def search_documents(search: SearchQuery):
         results = await rag_system.search(
             query=search.query,
             top_k=search.top_k,
-            metadata_filter=search.metadata_filter
+            metadata_filter=search.metadata_filter,
+            collection=search.collection
         )
         
         return {
@@ -151,6 +317,8 @@ async def search_documents(search: SearchQuery):
             "count": len(results),
             "timestamp": datetime.utcnow().isoformat()
         }
+    except StageOverloaded as e:
+        raise overloaded(e)
     except Exception as e:
         logger.error(f"Error searching documents: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -165,14 +333,109 @@ async def query_rag(query: Query):
             result = await rag_system.query(
                 question=query.question,
                 top_k=query.top_k,
-                metadata_filter=query.metadata_filter
+                metadata_filter=query.metadata_filter,
+                collection=query.collection
             )
         
+        if result.get('degraded'):
+            degraded_counter.inc()
+        
         return result
+    except StageOverloaded as e:
+        raise overloaded(e)
     except Exception as e:
         logger.error(f"Error processing query: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/indexes/filtered")
+async def create_filtered_index(request: FilteredIndexRequest):
+    """Build a partial ANN index for a frequently used metadata filter"""
+    try:
+        index_name = await rag_system.create_filtered_index(
+            request.metadata_filter,
+            lists=request.lists,
+            collection=request.collection
+        )
+        
+        return {
+            "status": "success",
+            "index_name": index_name,
+            "metadata_filter": request.metadata_filter,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error creating filtered index: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/collections")
+async def create_collection(collection: Collection):
+    """Create a collection with its own partition and ANN index"""
+    try:
+        await rag_system.create_collection(collection.name, lists=collection.lists)
+        
+        return {
+            "status": "success",
+            "collection": collection.name,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error creating collection: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/collections/{name}/reindex")
+async def rebuild_collection_index(name: str, rebuild: IndexRebuild):
+    """Rebuild the ANN index of one collection"""
+    try:
+        lists = await rag_system.rebuild_collection_index(name, lists=rebuild.lists)
+        
+        return {
+            "status": "success",
+            "collection": name,
+            "lists": lists,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error rebuilding collection index: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/admin/reembed")
+async def start_reembed(request: ReembedRequest):
+    """Start re-embedding every chunk with a new model, without downtime"""
+    try:
+        task = await rag_system.start_reembed(
+            request.embedding_model,
+            batch_size=request.batch_size,
+            max_rows_per_second=request.max_rows_per_second
+        )
+    except RuntimeError as e:
+        # Another worker (or this one) is running a job
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    def log_failure(task):
+        if not task.cancelled() and task.exception():
+            # Already recorded in reembed_jobs
+            logger.error(f"Re-embedding job failed: {task.exception()}")
+    
+    task.add_done_callback(log_failure)
+    return {
+        "status": "started",
+        "embedding_model": request.embedding_model,
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+@app.get("/admin/reembed")
+async def reembed_status():
+    """Progress and throughput of the running or last re-embedding job, from any worker"""
+    return await rag_system.reembed_status()
+
 @app.get("/stats")
 async def get_statistics():
     """Get system statistics"""
@@ -184,6 +447,8 @@ async def get_statistics():
                 "total_queries": query_counter._value.get(),
                 "total_documents_added": document_counter._value.get()
             },
+            "engine_stats": dict(rag_system.metrics),
+            "statement_stats": rag_system.statements.stats(),
             "timestamp": datetime.utcnow().isoformat()
         }
     except Exception as e:
@@ -193,6 +458,11 @@ async def get_statistics():
 @app.get("/metrics", response_class=PlainTextResponse)
 async def metrics():
     """Prometheus metrics endpoint"""
+    refresh_engine_gauges()
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
     return generate_latest()
 
 # Example usage endpoint
@@ -230,6 +500,100 @@ async def example_usage():
         "sample_result": result
     }
 
-if __name__ == "__main__":
+def serve_prefork(host: str, port: int, workers: int):
+    """Serve with `workers` processes forked after loading the models once.
+    
+    The parent loads the models, makes their weights read-only and forks;
+    workers share the weight pages copy-on-write, get an equal share of the
+    CPU threads and open their own asyncpg pools in the startup event. The
+    embedding model is the one recorded in the database, so workers do not
+    load another one after the fork. The embedding parity check runs once
+    here, before forking, rather than in every worker.
+    """
+    import gc
+    import signal
+    import socket
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    
+    global rag_system
+    rag_system = build_rag_system(asyncio.run(resolve_embedding_model()))
+    check_inference_parity()
+    rag_system.share_models()
+    
+    # Metric files of a previous run would be added to this one's
+    if PROMETHEUS_MULTIPROC_DIR:
+        for name in os.listdir(PROMETHEUS_MULTIPROC_DIR):
+            if name.endswith('.db'):
+                os.remove(os.path.join(PROMETHEUS_MULTIPROC_DIR, name))
+    
+    threads_per_worker = int(os.getenv('INFERENCE_THREADS', 0)) or max(1, (os.cpu_count() or 1) // workers)
+    
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    
+    # Keep the garbage collector from touching (and so copying) the
+    # parent's objects in every worker
+    gc.collect()
+    gc.freeze()
+    
+    def spawn_worker(worker_id: int) -> int:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            rag_system.reset_after_fork(threads_per_worker)
+            logger.info(f"Worker {worker_id} started (pid {os.getpid()}, {threads_per_worker} threads)")
+            server = uvicorn.Server(uvicorn.Config(app, log_level="info"))
+            server.run(sockets=[sock])
+            os._exit(0)
+        return pid
+    
+    children = {spawn_worker(worker_id): worker_id for worker_id in range(workers)}
+    stopping = False
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f"Serving on {host}:{port} with {workers} pre-forked workers")
+    
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        
+        worker_id = children.pop(pid, None)
+        if PROMETHEUS_MULTIPROC_DIR:
+            multiprocess.mark_process_dead(pid)
+        if worker_id is not None and not stopping:
+            logger.warning(f"Worker {worker_id} exited with status {status}, restarting")
+            children[spawn_worker(worker_id)] = worker_id
+    
+    sock.close()
+
+if __name__ == "__main__":
+    host = os.getenv('API_HOST', '0.0.0.0')
+    port = int(os.getenv('API_PORT', 8000))
+    workers = int(os.getenv('API_WORKERS', 1))
+    if workers > 1 and os.getenv('STORAGE_BACKEND', 'postgres') == 'numpy':
+        logger.warning("The numpy storage backend is per-process, serving with a single worker")
+        workers = 1
+    
+    if workers > 1:
+        serve_prefork(host, port, workers)
+    else:
+        import uvicorn
+        uvicorn.run(app, host=host, port=port)
\ No newline at end of file
@@ -2,7 +2,7 @@ import asyncio
 import time
 import random
 import string
-from postgres_rag import PostgresRAG
+from postgres_rag import PostgresRAG, DEFAULT_COLLECTION, VECTOR_STORAGE_MODES
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -16,7 +16,8 @@ class RAGBenchmark:
             'search_times': [],
             'generation_times': [],
             'documents_count': [],
-            'cache_hit_rates': []
+            'cache_hit_rates': [],
+            'storage_modes': []
         }
     
     def generate_random_document(self, length=500):
@@ -51,6 +52,9 @@ class RAGBenchmark:
         # Test 4: Concurrent query handling
         await self.benchmark_concurrent_queries(rag)
         
+        # Test 5: Compact vector storage tradeoff
+        await self.benchmark_vector_storage(rag)
+        
         await rag.close()
         
         # Generate report
@@ -172,6 +176,80 @@ class RAGBenchmark:
             
             print(f"Concurrent queries: {count}, Time: {elapsed:.2f}s, QPS: {qps:.2f}")
     
+    async def benchmark_vector_storage(self, rag, top_k=10):
+        """Benchmark index size, latency and recall of each vector storage mode"""
+        print("\n5. Vector Storage Benchmark")
+        print("-" * 30)
+        
+        queries = [
+            "database performance",
+            "vector search index",
+            "machine learning algorithm",
+            "query optimization",
+            "data storage"
+        ]
+        
+        # Exact ground truth over every stored vector
+        async with rag.pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT id, embedding FROM documents WHERE collection = $1",
+                DEFAULT_COLLECTION
+            )
+        
+        if not rows:
+            print("No documents to benchmark")
+            return
+        
+        ids = np.array([r['id'] for r in rows])
+        matrix = np.stack([r['embedding'] for r in rows])
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        
+        index_name = f"idx_documents_{DEFAULT_COLLECTION}_embedding"
+        original_mode = rag.vector_storage
+        full_index_bytes = None
+        
+        for mode in VECTOR_STORAGE_MODES:
+            rag.vector_storage = mode
+            await rag.rebuild_collection_index(DEFAULT_COLLECTION)
+            
+            async with rag.pool.acquire() as conn:
+                index_bytes = await conn.fetchval("SELECT pg_relation_size($1::regclass)", index_name)
+            
+            search_times = []
+            recalls = []
+            for query in queries:
+                query_embedding = await rag.generate_embedding(query)
+                scores = matrix @ (query_embedding / np.linalg.norm(query_embedding))
+                expected = set(ids[np.argsort(-scores)[:top_k]].tolist())
+                
+                start_time = time.time()
+                async with rag.pool.acquire() as conn:
+                    results = await rag._search_rows(conn, query_embedding, top_k)
+                search_times.append(time.time() - start_time)
+                
+                recalls.append(len(expected & {r['id'] for r in results}) / min(top_k, len(ids)))
+            
+            if full_index_bytes is None:
+                full_index_bytes = index_bytes
+            
+            result = {
+                'mode': mode,
+                'index_bytes': index_bytes,
+                'compression': full_index_bytes / max(index_bytes, 1),
+                'avg_search_ms': np.mean(search_times) * 1000,
+                'recall': np.mean(recalls)
+            }
+            self.results['storage_modes'].append(result)
+            
+            print(f"Storage: {mode}, Index: {index_bytes / 1024 / 1024:.2f}MB "
+                  f"({result['compression']:.1f}x smaller), "
+                  f"Avg search: {result['avg_search_ms']:.2f}ms, "
+                  f"Recall@{top_k}: {result['recall']:.3f}")
+        
+        # Restore the configured index
+        rag.vector_storage = original_mode
+        await rag.rebuild_collection_index(DEFAULT_COLLECTION)
+    
     def generate_report(self):
         """Generate benchmark report with visualizations"""
         print("\n" + "=" * 50)
@@ -0,0 +1,201 @@
+import logging
+import os
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_BACKENDS = ("torch", "torch-int8", "onnx")
+DEFAULT_ONNX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "rag-postgresql", "onnx")
+
+
+def configure_threads(num_threads: Optional[int] = None, num_interop_threads: Optional[int] = None):
+    """Set torch intra-op and inter-op thread counts"""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            # Only allowed before the first inter-op parallel work in the process
+            logger.warning(f"Could not set inter-op threads: {e}")
+
+    logger.info(f"Torch threads: intra-op={torch.get_num_threads()}, inter-op={torch.get_num_interop_threads()}")
+
+
+def _conv1d_to_linear(model: torch.nn.Module) -> int:
+    """Replace GPT-2 style Conv1D layers (x @ W + b with W stored as (in, out))
+    by the equivalent nn.Linear, so that dynamic quantization applies to them"""
+    try:
+        from transformers.pytorch_utils import Conv1D
+    except ImportError:
+        return 0
+
+    replaced = 0
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features, device='meta')
+                linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous(), requires_grad=False)
+                linear.bias = torch.nn.Parameter(child.bias.detach(), requires_grad=False)
+                setattr(parent, name, linear)
+                replaced += 1
+    return replaced
+
+
+def quantize_int8(model: torch.nn.Module) -> torch.nn.Module:
+    """Dynamically quantize the Linear layers of a model to int8.
+
+    Weights are stored as int8 and activations are quantized on the fly, which
+    mostly speeds up CPU inference. GPT-2's Conv1D projections are converted
+    to nn.Linear first so they are quantized too. An output layer tied to the
+    input embeddings (GPT-2's lm_head) stays fp32: quantizing it would add an
+    int8 copy next to the fp32 embedding table it shares its weights with.
+    """
+    model.eval()
+    converted = _conv1d_to_linear(model)
+
+    output_embeddings = getattr(model, 'get_output_embeddings', lambda: None)()
+    input_embeddings = getattr(model, 'get_input_embeddings', lambda: None)()
+    tied = (
+        output_embeddings is not None and input_embeddings is not None
+        and output_embeddings.weight is input_embeddings.weight
+    )
+    qconfig_spec = {
+        name: torch.quantization.default_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and not (tied and module is output_embeddings)
+    }
+
+    logger.info(f"Quantizing {len(qconfig_spec)} Linear layers to int8 ({converted} converted from Conv1D)")
+    return torch.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+
+class _HiddenStates(torch.nn.Module):
+    """Wraps a Hugging Face encoder so the exported graph returns a plain tensor"""
+
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, *inputs):
+        return self.model(*inputs)[0]
+
+
+class OnnxEmbeddingEncoder:
+    """ONNX Runtime version of a mean-pooling SentenceTransformer encoder.
+
+    The transformer is exported once to `export_dir`; pooling and
+    normalization run in NumPy. `encode` mirrors `SentenceTransformer.encode`
+    for the arguments this project uses.
+    """
+
+    def __init__(
+        self,
+        sentence_model,
+        export_dir: str,
+        num_threads: Optional[int] = None,
+        num_interop_threads: Optional[int] = None
+    ):
+        try:
+            import onnxruntime  # noqa: F401
+        except ImportError as e:
+            raise ImportError("The 'onnx' inference backend requires the onnxruntime package") from e
+
+        transformer, pooling = sentence_model[0], sentence_model[1]
+        if not getattr(pooling, 'pooling_mode_mean_tokens', False):
+            raise ValueError("The 'onnx' inference backend only supports mean-pooling embedding models")
+
+        self.tokenizer = transformer.tokenizer
+        self.max_seq_length = transformer.max_seq_length
+        self.normalize = any(type(module).__name__ == 'Normalize' for module in sentence_model)
+
+        sample = self.tokenizer(["export"], return_tensors="pt")
+        self.input_names = [
+            name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in sample
+        ]
+
+        model_path = os.path.join(export_dir, "model.onnx")
+        if not os.path.exists(model_path):
+            os.makedirs(export_dir, exist_ok=True)
+            logger.info(f"Exporting embedding encoder to {model_path}")
+            dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in self.input_names}
+            dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+
+            with torch.no_grad():
+                torch.onnx.export(
+                    _HiddenStates(transformer.auto_model.eval()),
+                    tuple(sample[name] for name in self.input_names),
+                    model_path,
+                    input_names=self.input_names,
+                    output_names=['last_hidden_state'],
+                    dynamic_axes=dynamic_axes,
+                    opset_version=14
+                )
+
+        self.model_path = model_path
+        self.reset_session(num_threads, num_interop_threads)
+
+    def reset_session(self, num_threads: Optional[int] = None, num_interop_threads: Optional[int] = None):
+        """Create the ONNX Runtime session.
+
+        Forked workers call this again: their copy of the parent's session
+        has lost its thread pool.
+        """
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        if num_interop_threads:
+            options.inter_op_num_threads = num_interop_threads
+
+        self.session = ort.InferenceSession(self.model_path, options, providers=['CPUExecutionProvider'])
+
+    def encode(self, sentences: Union[str, List[str]], batch_size: int = 32, **kwargs) -> np.ndarray:
+        """Embed one sentence (1-D result) or a list of sentences (2-D result)"""
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        embeddings = []
+        for i in range(0, len(sentences), batch_size):
+            batch = self.tokenizer(
+                sentences[i:i + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np"
+            )
+            feeds = {name: batch[name].astype(np.int64) for name in self.input_names}
+            hidden = self.session.run(None, feeds)[0]
+
+            # Mean pooling over the non-padding tokens
+            mask = batch['attention_mask'][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.normalize:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            embeddings.append(pooled.astype(np.float32))
+
+        embeddings = np.concatenate(embeddings)
+        return embeddings[0] if single else embeddings
+
+
+def embedding_parity(reference, candidate, texts: List[str]) -> Dict[str, float]:
+    """Cosine similarity between the embeddings of two encoders"""
+    expected = np.asarray(reference.encode(texts), dtype=np.float32)
+    actual = np.asarray(candidate.encode(texts), dtype=np.float32)
+
+    cosines = (expected * actual).sum(axis=1) / (
+        np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1)
+    )
+
+    return {
+        'min_cosine': float(cosines.min()),
+        'mean_cosine': float(cosines.mean())
+    }
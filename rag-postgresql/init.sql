@@ -1,18 +1,38 @@
 -- Enable pgvector extension
 CREATE EXTENSION IF NOT EXISTS vector;
 
--- Create documents table
+-- Create documents table, partitioned by collection so that each
+-- collection gets its own ANN index and searches prune to one partition
 CREATE TABLE IF NOT EXISTS documents (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
+    collection TEXT NOT NULL DEFAULT 'default',
     content TEXT NOT NULL,
-    embedding vector(384), -- Dimension for all-MiniLM-L6-v2
+    embedding vector(384), -- Dimension for all-MiniLM-L6-v2 (PostgresRAG.reembed changes it online)
     metadata JSONB DEFAULT '{}',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (collection, id)
+) PARTITION BY LIST (collection);
+
+-- Registry of collections and their partitions
+-- (new ones are created by PostgresRAG.create_collection)
+CREATE TABLE IF NOT EXISTS collections (
+    name TEXT PRIMARY KEY,
+    partition_name TEXT UNIQUE NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
--- Create indexes for efficient search
-CREATE INDEX idx_documents_embedding ON documents 
+CREATE TABLE IF NOT EXISTS documents_default PARTITION OF documents FOR VALUES IN ('default');
+INSERT INTO collections (name, partition_name) VALUES ('default', 'documents_default')
+ON CONFLICT (name) DO NOTHING;
+
+-- Create indexes for efficient search (one ANN index per partition).
+-- With PostgresRAG(vector_storage="halfvec" | "binary") the index is built
+-- over a compact expression instead, e.g.
+--   USING ivfflat ((embedding::halfvec(384)) halfvec_cosine_ops)
+--   USING ivfflat ((binary_quantize(embedding)::bit(384)) bit_hamming_ops)
+-- and search re-ranks the candidates by exact float32 distance.
+CREATE INDEX idx_documents_default_embedding ON documents_default 
 USING ivfflat (embedding vector_cosine_ops)
 WITH (lists = 100);
 
@@ -36,12 +56,15 @@ CREATE TRIGGER update_documents_updated_at BEFORE UPDATE
 CREATE TABLE IF NOT EXISTS search_history (
     id SERIAL PRIMARY KEY,
     query TEXT NOT NULL,
-    query_embedding vector(384),
+    query_embedding halfvec(384), -- Analytics only, half precision is enough
     results_count INTEGER,
     response_time_ms INTEGER,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Recent-window scans for the startup cache warm-up
+CREATE INDEX idx_search_history_created ON search_history(created_at);
+
 -- Create cache table for frequent queries
 CREATE TABLE IF NOT EXISTS embedding_cache (
     id SERIAL PRIMARY KEY,
@@ -54,4 +77,41 @@ CREATE TABLE IF NOT EXISTS embedding_cache (
 );
 
 CREATE INDEX idx_cache_hash ON embedding_cache(text_hash);
-CREATE INDEX idx_cache_accessed ON embedding_cache(last_accessed);
\ No newline at end of file
+CREATE INDEX idx_cache_accessed ON embedding_cache(last_accessed);
+
+-- Partial ANN indexes built for hot metadata filters
+-- (see PostgresRAG.create_filtered_index)
+CREATE TABLE IF NOT EXISTS filtered_indexes (
+    id SERIAL PRIMARY KEY,
+    collection TEXT NOT NULL REFERENCES collections(name),
+    filter JSONB NOT NULL,
+    index_name TEXT UNIQUE NOT NULL,
+    predicate TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Embedding model the stored vectors come from; every worker loads it and
+-- follows switches made by PostgresRAG.reembed
+CREATE TABLE IF NOT EXISTS embedding_model (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    name TEXT NOT NULL,
+    dimension INTEGER NOT NULL,
+    generation INTEGER NOT NULL DEFAULT 1,
+    switched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+INSERT INTO embedding_model (name, dimension) VALUES ('all-MiniLM-L6-v2', 384)
+ON CONFLICT (id) DO NOTHING;
+
+-- Progress of re-embedding jobs, readable from every worker
+CREATE TABLE IF NOT EXISTS reembed_jobs (
+    id SERIAL PRIMARY KEY,
+    embedding_model TEXT NOT NULL,
+    state TEXT NOT NULL,
+    rows_total BIGINT,
+    rows_done BIGINT NOT NULL DEFAULT 0,
+    rows_per_second REAL NOT NULL DEFAULT 0,
+    failed_while TEXT,
+    error TEXT,
+    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -1,8 +1,16 @@
 import asyncio
+import copy
 import hashlib
 import json
+import math
+import os
+import re
+import struct
+import threading
 import time
-from typing import List, Dict, Optional, Tuple
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, List, Dict, Optional, Tuple
 import asyncpg
 import numpy as np
 from sentence_transformers import SentenceTransformer
@@ -11,52 +19,610 @@ import torch
 from datetime import datetime
 import logging
 
+from inference_backend import (
+    DEFAULT_ONNX_DIR,
+    INFERENCE_BACKENDS,
+    OnnxEmbeddingEncoder,
+    configure_threads,
+    embedding_parity,
+    quantize_int8,
+)
+from snapshot import Snapshot, SnapshotWriter
+from storage import VectorStore
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DEFAULT_COLLECTION = "default"
+COLLECTION_NAME_RE = re.compile(r'^[a-z0-9_]{1,48}$')
+VECTOR_STORAGE_MODES = ("full", "halfvec", "binary")
+DEFAULT_ADMISSION = {
+    'embedding': {'max_concurrency': 4, 'max_queue': 64, 'queue_timeout': 10.0},
+    'generation': {'max_concurrency': 2, 'max_queue': 16, 'queue_timeout': 30.0}
+}
+# Model switches (see PostgresRAG.reembed): the job announces each step on
+# this channel, and workers show in application_name whether they have
+# loaded the new model. At most one job runs, holding this advisory lock.
+MODEL_SWITCH_CHANNEL = "embedding_model"
+WORKER_APPLICATION_NAME = "rag-worker"
+MODEL_SWITCH_TIMEOUT = 30.0
+REEMBED_LOCK = (0x52414745, 1)
+REEMBED_DONE_STATES = ('completed', 'failed', 'cancelled')
+PROMPT_PREFIX = """Based on the following context, answer the question accurately and concisely.
+
+Context:
+"""
+
+
+def _encode_vector(value) -> bytes:
+    """Encode a vector in pgvector's binary format"""
+    array = np.asarray(value, dtype='>f4')
+    return struct.pack('>HH', array.shape[0], 0) + array.tobytes()
+
+
+def _decode_vector(data: bytes) -> np.ndarray:
+    """Decode a vector from pgvector's binary format"""
+    dim, _ = struct.unpack_from('>HH', data)
+    return np.frombuffer(data, dtype='>f4', count=dim, offset=4).astype(np.float32)
+
+
+class StageOverloaded(Exception):
+    """Raised when a stage's wait queue is full or a request waited too long"""
+    
+    def __init__(self, stage: str, reason: str, retry_after: int):
+        super().__init__(f"{stage} stage overloaded ({reason}), retry after {retry_after}s")
+        self.stage = stage
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class StageLimiter:
+    """Concurrency limit for one pipeline stage with a bounded wait queue.
+    
+    Up to `max_concurrency` requests run at once and up to `max_queue` wait
+    for a slot, each for at most `queue_timeout` seconds. Anything beyond
+    that is rejected right away with `StageOverloaded` instead of queueing
+    work that clients will have given up on by the time it runs.
+    """
+    
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = Counter()
+        self._service_time = 1.0
+        self._semaphore = None
+    
+    def retry_after(self) -> int:
+        """Seconds until the current backlog is expected to drain"""
+        backlog = (self.waiting + 1) / self.max_concurrency
+        return max(1, math.ceil(backlog * self._service_time))
+    
+    def _reject(self, reason: str):
+        self.rejected[reason] += 1
+        raise StageOverloaded(self.name, reason, self.retry_after())
+    
+    @asynccontextmanager
+    async def slot(self, bounded: bool = True):
+        """Hold one of the stage's slots; `bounded=False` waits without limits"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        if bounded and self._semaphore.locked() and self.waiting >= self.max_queue:
+            self._reject('queue_full')
+        
+        self.waiting += 1
+        try:
+            if bounded:
+                await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+            else:
+                await self._semaphore.acquire()
+        except asyncio.TimeoutError:
+            self._reject('deadline')
+        finally:
+            self.waiting -= 1
+        
+        self.active += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            # Moving average of the service time, for Retry-After estimates
+            self._service_time = 0.8 * self._service_time + 0.2 * (time.perf_counter() - start)
+            self.active -= 1
+            self._semaphore.release()
+
+
+class StatementRegistry:
+    """Fixed SQL text for every hot query shape, with per-statement timings.
+    
+    asyncpg prepares statements once per connection and caches them by SQL
+    text, so giving each shape exactly one text means every pooled connection
+    parses and plans it once and afterwards only binds and executes it.
+    """
+    
+    def __init__(self):
+        self._sql: Dict[Tuple, str] = {}
+        self._timings: Dict[str, List[float]] = {}
+    
+    def sql(self, name: str, shape: Tuple, build) -> str:
+        """SQL text of a statement shape, built on first use"""
+        key = (name, shape)
+        text = self._sql.get(key)
+        if text is None:
+            text = self._sql[key] = build()
+        return text
+    
+    async def run(self, conn, method: str, name: str, shape: Tuple, build, *args):
+        """Execute a registered statement with `conn.<method>` and time it"""
+        text = self.sql(name, shape, build)
+        start = time.perf_counter()
+        try:
+            return await getattr(conn, method)(text, *args)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            timing = self._timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += elapsed_ms
+            timing[2] = max(timing[2], elapsed_ms)
+    
+    def clear(self):
+        """Forget the built SQL texts (after a schema or storage mode change)"""
+        self._sql.clear()
+    
+    def stats(self) -> Dict[str, Dict]:
+        """Calls, average and max latency per statement"""
+        return {
+            name: {
+                'calls': calls,
+                'avg_ms': round(total_ms / calls, 3),
+                'max_ms': round(max_ms, 3)
+            }
+            for name, (calls, total_ms, max_ms) in self._timings.items()
+        }
+
 
 class PostgresRAG:
     """High-performance RAG implementation using PostgreSQL with pgvector"""
     
     def __init__(
         self,
-        db_config: Dict[str, str],
+        db_config: Optional[Dict[str, str]],
         embedding_model_name: str = "all-MiniLM-L6-v2",
         llm_model_name: str = "gpt2",
-        use_cache: bool = True
+        use_cache: bool = True,
+        exact_search_threshold: int = 2000,
+        filter_overfetch: int = 4,
+        max_overfetch_rounds: int = 3,
+        ivfflat_probes: int = 1,
+        vector_storage: str = "full",
+        rerank_factor: int = 4,
+        context_token_budget: int = 768,
+        chunk_kv_cache_size: int = 0,
+        chunk_kv_min_hits: int = 2,
+        inference_backend: str = "torch",
+        num_threads: Optional[int] = None,
+        num_interop_threads: Optional[int] = None,
+        onnx_model_dir: Optional[str] = None,
+        admission: Optional[Dict[str, Dict]] = None,
+        degrade_on_overload: bool = False,
+        load_models: bool = True,
+        load_llm: bool = True,
+        storage: Optional[VectorStore] = None,
+        embedding_lru_size: int = 1024
     ):
-        self.db_config = db_config
+        self.db_config = db_config or {}
         self.use_cache = use_cache
         self.pool = None
         
+        # Optional storage backend replacing PostgreSQL for ingestion, search,
+        # the embedding cache and stats (e.g. storage.NumpyVectorStore)
+        self.storage = storage
+        
+        # In-process LRU in front of the embedding cache, filled on demand
+        # and by warm_up() from the hottest queries in search_history
+        self.embedding_lru_size = embedding_lru_size
+        self._embedding_lru: OrderedDict = OrderedDict()
+        self.ready = False
+        self.warmup_stats: Dict = {}
+        
+        # Writes go to `pool` on the primary; reads (searches, cache lookups,
+        # stats) go to separate read pools on the replicas listed in
+        # db_config['replicas'], or on the primary when there are none.
+        self.read_pools = []
+        self.read_routing = self.db_config.get('read_routing', 'round_robin')
+        self.acquire_timeout = self.db_config.get('acquire_timeout')
+        self._read_index = 0
+        self._background_tasks = set()
+        self.statements = StatementRegistry()
+        
+        # Filtered search planning: metadata filters matching at most
+        # `exact_search_threshold` rows are searched exactly over the
+        # pre-filtered set; broader filters over-fetch from the ANN index
+        # and post-filter, widening the scan on every round.
+        self.exact_search_threshold = exact_search_threshold
+        self.filter_overfetch = filter_overfetch
+        self.max_overfetch_rounds = max_overfetch_rounds
+        self.ivfflat_probes = ivfflat_probes
+        self.filtered_indexes: Dict[Tuple[str, str], str] = {}
+        self.collections = set()
+        
+        # Compact storage: the ANN index is built over a halfvec or
+        # binary-quantized expression of `embedding`, and candidates read
+        # from it are re-ranked by exact float32 distance.
+        if vector_storage not in VECTOR_STORAGE_MODES:
+            raise ValueError(f"vector_storage must be one of {VECTOR_STORAGE_MODES}")
+        self.vector_storage = vector_storage
+        self.rerank_factor = rerank_factor
+        
+        # Tokens of retrieved context packed into the generation prompt
+        self.context_token_budget = context_token_budget
+        
+        # KV-cache reuse: the fixed prompt prefix is prefilled once, and
+        # optionally the prefix + first document for chunks that keep
+        # ranking first (each entry holds the KV state of a few hundred tokens).
+        self.chunk_kv_cache_size = chunk_kv_cache_size
+        self.chunk_kv_min_hits = chunk_kv_min_hits
+        self._prefix_kv = None
+        self._chunk_kv_cache = OrderedDict()
+        # Hit counts of chunks not cached yet, least recently seen dropped first
+        self._chunk_kv_hits = OrderedDict()
+        self.chunk_kv_candidates = 8 * chunk_kv_cache_size
+        self._kv_lock = threading.Lock()
+        self.metrics = Counter()
+        
+        # Identical searches/queries in flight share one execution
+        self._inflight: Dict[Tuple, asyncio.Future] = {}
+        
+        # Admission control for the CPU-bound stages; with degrade_on_overload
+        # an overloaded generation stage returns retrieval-only results
+        self.admission = {
+            stage: {**limits, **(admission or {}).get(stage, {})}
+            for stage, limits in DEFAULT_ADMISSION.items()
+        }
+        self.limiters = {
+            stage: StageLimiter(stage, **limits) for stage, limits in self.admission.items()
+        }
+        self.degrade_on_overload = degrade_on_overload
+        
+        # Inference backend: "torch" (fp32 eager), "torch-int8" (dynamic
+        # int8 quantization of both models) or "onnx" (exported embedding
+        # encoder on ONNX Runtime, LLM in torch)
+        if inference_backend not in INFERENCE_BACKENDS:
+            raise ValueError(f"inference_backend must be one of {INFERENCE_BACKENDS}")
+        self.inference_backend = inference_backend
+        self.embedding_model_name = embedding_model_name
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+        configure_threads(num_threads, num_interop_threads)
+        
+        # The active embedding model is recorded in the embedding_model
+        # table; workers follow switches made by a re-embedding job in any
+        # process (see reembed), and embedding waits on `_model_ready`
+        # while a switch is being committed.
+        self._listener = None
+        self._model_generation = None
+        self._prepared_model = None
+        self._model_lock = asyncio.Lock()
+        self._model_ready = asyncio.Event()
+        self._model_ready.set()
+        self._reembed_task = None
+        
+        # Maintenance tools (e.g. snapshot export/import) only need the database
+        self.embedding_model = None
+        self.llm_model = None
+        self.tokenizer = None
+        self.embedding_dim = None
+        if not load_models:
+            return
+        
         # Initialize models
-        logger.info(f"Loading embedding model: {embedding_model_name}")
-        self.embedding_model = SentenceTransformer(embedding_model_name)
-        self.embedding_dim = self.embedding_model.get_sentence_embedding_dimension()
+        self.embedding_model, self.embedding_dim = self._load_embedding_model(embedding_model_name, onnx_model_dir)
+        if self.storage is not None:
+            # The store refuses snapshots embedded with another model
+            self.storage.embedding_model = embedding_model_name
+            self.storage.dim = self.embedding_dim
+        
+        # Ingestion-only tools embed but never generate
+        if not load_llm:
+            return
         
         logger.info(f"Loading LLM model: {llm_model_name}")
         self.tokenizer = AutoTokenizer.from_pretrained(llm_model_name)
         self.llm_model = AutoModelForCausalLM.from_pretrained(llm_model_name)
         
+        if inference_backend == "torch-int8":
+            self.llm_model = quantize_int8(self.llm_model)
+        
         # Set padding token
         if self.tokenizer.pad_token is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
     
-    async def connect(self):
-        """Create connection pool to PostgreSQL"""
-        self.pool = await asyncpg.create_pool(
-            host=self.db_config.get('host', 'localhost'),
-            port=self.db_config.get('port', 5432),
+    def _load_embedding_model(self, model_name: str, onnx_model_dir: Optional[str] = None):
+        """Load an embedding model on the configured inference backend, with its dimension"""
+        logger.info(f"Loading embedding model: {model_name} ({self.inference_backend})")
+        model = SentenceTransformer(model_name)
+        dim = model.get_sentence_embedding_dimension()
+        
+        if self.inference_backend == "torch-int8":
+            model = quantize_int8(model)
+        elif self.inference_backend == "onnx":
+            export_dir = onnx_model_dir or os.path.join(DEFAULT_ONNX_DIR, model_name.replace('/', '__'))
+            model = OnnxEmbeddingEncoder(model, export_dir, self.num_threads, self.num_interop_threads)
+        
+        return model, dim
+    
+    def share_models(self):
+        """Make the model weights read-only before forking workers.
+        
+        Workers forked afterwards share the weight pages copy-on-write; with
+        gradients disabled and inference only, those pages are never written.
+        """
+        for model in (self.embedding_model, self.llm_model):
+            if isinstance(model, torch.nn.Module):
+                model.eval()
+                for parameter in model.parameters():
+                    parameter.requires_grad_(False)
+    
+    def reset_after_fork(self, num_threads: Optional[int] = None):
+        """Re-initialize per-process state in a forked worker"""
+        self.pool = None
+        self.read_pools = []
+        self._background_tasks = set()
+        self._kv_lock = threading.Lock()
+        self.metrics = Counter()
+        self._inflight = {}
+        self.ready = False
+        self._listener = None
+        self._model_lock = asyncio.Lock()
+        self._model_ready = asyncio.Event()
+        self._model_ready.set()
+        self._reembed_task = None
+        self.limiters = {
+            stage: StageLimiter(stage, **limits) for stage, limits in self.admission.items()
+        }
+        
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        if hasattr(self.embedding_model, 'reset_session'):
+            self.embedding_model.reset_session(num_threads)
+    
+    @staticmethod
+    async def read_active_model(db_config: Dict) -> Optional[str]:
+        """Name of the embedding model the stored vectors come from, if recorded"""
+        conn = await asyncpg.connect(
+            host=db_config.get('host', 'localhost'),
+            port=db_config.get('port', 5432),
+            user=db_config['user'],
+            password=db_config['password'],
+            database=db_config['database']
+        )
+        try:
+            # connect() reports a schema that predates the table
+            if not await conn.fetchval("SELECT to_regclass('embedding_model') IS NOT NULL"):
+                return None
+            return await conn.fetchval("SELECT name FROM embedding_model")
+        finally:
+            await conn.close()
+    
+    async def _create_pool(self, host: str, port: int, min_size: int, max_size: int):
+        """Create a connection pool to one PostgreSQL server"""
+        return await asyncpg.create_pool(
+            host=host,
+            port=port,
             user=self.db_config['user'],
             password=self.db_config['password'],
             database=self.db_config['database'],
-            min_size=10,
-            max_size=20
+            min_size=min_size,
+            max_size=max_size,
+            command_timeout=self.db_config.get('command_timeout'),
+            statement_cache_size=self.db_config.get('statement_cache_size', 100),
+            init=self._init_connection
+        )
+    
+    async def connect(self):
+        """Create the write pool on the primary and the read pools"""
+        if self.storage is not None:
+            await self.storage.connect()
+            return
+        
+        host = self.db_config.get('host', 'localhost')
+        port = self.db_config.get('port', 5432)
+        read_min = self.db_config.get('read_pool_min_size', 10)
+        read_max = self.db_config.get('read_pool_max_size', 20)
+        
+        self.pool = await self._create_pool(
+            host, port,
+            self.db_config.get('write_pool_min_size', 2),
+            self.db_config.get('write_pool_max_size', 10)
+        )
+        
+        replicas = self.db_config.get('replicas') or [{'host': host, 'port': port}]
+        self.read_pools = [
+            await self._create_pool(replica.get('host', host), replica.get('port', port), read_min, read_max)
+            for replica in replicas
+        ]
+        
+        await self._check_schema()
+        await self._load_collections()
+        await self._load_filtered_indexes()
+        if self.embedding_model is not None:
+            await self._follow_active_model()
+            await self._listen_for_model_switches()
+        else:
+            await self._read_active_model()
+        logger.info(f"Connected to PostgreSQL ({len(self.read_pools)} read pool(s), {self.read_routing} routing)")
+    
+    async def warm_up(
+        self,
+        top_n: int = 200,
+        sample_searches: int = 20,
+        since_hours: int = 24,
+        budget: float = 30.0,
+        prewarm_indexes: bool = False
+    ) -> Dict:
+        """Prime the caches with the hottest recent queries, then mark the system ready.
+        
+        Loads the embeddings of the `top_n` most frequent queries of the last
+        `since_hours` from embedding_cache into the in-process LRU (embedding
+        the ones missing from it), runs `sample_searches` of them against every
+        read pool to pull the ANN index pages into shared buffers and, with
+        `prewarm_indexes`, loads the ANN indexes with pg_prewarm. Stops when
+        `budget` seconds have passed; `ready` is set either way.
+        """
+        start_time = time.time()
+        self.warmup_stats = stats = {
+            'embeddings_loaded': 0,
+            'embedded': 0,
+            'searches': 0,
+            'prewarmed_blocks': 0,
+            'completed': False
+        }
+        
+        try:
+            if self.storage is None and top_n > 0:
+                await asyncio.wait_for(
+                    self._warm_up(stats, top_n, sample_searches, since_hours, prewarm_indexes), budget
+                )
+            stats['completed'] = True
+        except asyncio.TimeoutError:
+            logger.warning(f"Warm-up budget of {budget}s exhausted")
+        except Exception as e:
+            # A cold cache is slower, not broken
+            logger.error(f"Warm-up failed: {e}")
+        finally:
+            stats['elapsed_seconds'] = round(time.time() - start_time, 3)
+            self.ready = True
+        
+        logger.info(f"Warm-up finished: {stats}")
+        return stats
+    
+    async def _warm_up(
+        self,
+        stats: Dict,
+        top_n: int,
+        sample_searches: int,
+        since_hours: int,
+        prewarm_indexes: bool
+    ):
+        """Warm-up steps; progress is recorded in `stats` as they complete"""
+        async with self._read_conn() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT h.query, c.embedding
+                FROM (
+                    SELECT query, COUNT(*) AS hits, MAX(created_at) AS last_seen
+                    FROM search_history
+                    WHERE created_at > CURRENT_TIMESTAMP - make_interval(hours => $1)
+                    GROUP BY query
+                    ORDER BY hits DESC, last_seen DESC
+                    LIMIT $2
+                ) h
+                LEFT JOIN embedding_cache c
+                    ON c.text_hash = encode(sha256(convert_to($3 || E'\\n' || h.query, 'UTF8')), 'hex')
+                ORDER BY h.hits DESC, h.last_seen DESC
+                """,
+                since_hours, top_n, self.embedding_model_name
+            )
+        
+        embeddings = {r['query']: np.array(r['embedding']) for r in rows if r['embedding'] is not None}
+        stats['embeddings_loaded'] = len(embeddings)
+        
+        missing = [r['query'] for r in rows if r['query'] not in embeddings]
+        if missing:
+            loop = asyncio.get_running_loop()
+            encoded = await loop.run_in_executor(None, self.embedding_model.encode, missing)
+            embeddings.update(zip(missing, encoded))
+            stats['embedded'] = len(missing)
+        
+        # Coldest first, so the hottest queries end up most recently used
+        for row in reversed(rows):
+            self._remember_embedding(self._text_hash(row['query']), embeddings[row['query']])
+        
+        # Replicas have their own shared buffers, so prime each read pool
+        for pool in self.read_pools:
+            async with pool.acquire(timeout=self.acquire_timeout) as conn:
+                if prewarm_indexes and await conn.fetchval(
+                    "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_prewarm')"
+                ):
+                    stats['prewarmed_blocks'] += await conn.fetchval(
+                        """
+                        SELECT COALESCE(SUM(pg_prewarm(c.oid)), 0)::bigint
+                        FROM pg_class c
+                        JOIN pg_am am ON am.oid = c.relam
+                        WHERE c.relkind = 'i' AND am.amname IN ('ivfflat', 'hnsw')
+                        """
+                    )
+                
+                for row in rows[:sample_searches]:
+                    await self._search_rows(conn, embeddings[row['query']], 5, None, None)
+                    stats['searches'] += 1
+    
+    def _read_pool(self):
+        """Pick a read pool by round-robin or by fewest connections in use"""
+        if len(self.read_pools) == 1:
+            return self.read_pools[0]
+        
+        if self.read_routing == 'least_loaded':
+            return min(self.read_pools, key=lambda pool: pool.get_size() - pool.get_idle_size())
+        
+        self._read_index = (self._read_index + 1) % len(self.read_pools)
+        return self.read_pools[self._read_index]
+    
+    def _require_database(self, operation: str):
+        """Raise ValueError for PostgreSQL-only operations when a storage backend replaces it"""
+        if self.storage is not None:
+            raise ValueError(f"{operation} is only available with the PostgreSQL storage")
+    
+    def _read_conn(self):
+        """Acquire a connection for a read-only query"""
+        return self._read_pool().acquire(timeout=self.acquire_timeout)
+    
+    def _write_conn(self):
+        """Acquire a connection on the primary"""
+        return self.pool.acquire(timeout=self.acquire_timeout)
+    
+    def _spawn(self, coro):
+        """Run a coroutine in the background, keeping a reference until it ends"""
+        task = asyncio.ensure_future(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+    
+    @staticmethod
+    async def _init_connection(conn):
+        """Register the pgvector codec on a new pooled connection"""
+        await conn.set_type_codec(
+            'vector',
+            schema='public',
+            encoder=_encode_vector,
+            decoder=_decode_vector,
+            format='binary'
         )
-        logger.info("Connected to PostgreSQL")
     
     async def close(self):
-        """Close connection pool"""
+        """Close connection pools"""
+        if self._reembed_task and not self._reembed_task.done():
+            self._reembed_task.cancel()
+            await asyncio.gather(self._reembed_task, return_exceptions=True)
+        
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        
+        if self.storage is not None:
+            await self.storage.close()
+        
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
+        
+        for pool in self.read_pools:
+            await pool.close()
+        self.read_pools = []
+        
         if self.pool:
             await self.pool.close()
     
@@ -87,35 +653,83 @@ class PostgresRAG:
         if not self.use_cache:
             return None
         
-        text_hash = hashlib.sha256(text.encode()).hexdigest()
+        text_hash = self._text_hash(text)
         
-        async with self.pool.acquire() as conn:
-            result = await conn.fetchrow(
-                """
+        embedding = self._embedding_lru.get(text_hash)
+        if embedding is not None:
+            self._embedding_lru.move_to_end(text_hash)
+            return embedding
+        
+        if self.storage is not None:
+            embedding = await self.storage.get_cached_embedding(text_hash)
+            if embedding is not None:
+                self._remember_embedding(text_hash, embedding)
+            return embedding
+        
+        async with self._read_conn() as conn:
+            result = await self.statements.run(
+                conn, 'fetchrow', 'cache_lookup', (),
+                lambda: "SELECT embedding FROM embedding_cache WHERE text_hash = $1",
+                text_hash
+            )
+        
+        if result:
+            # Hit accounting is a write, keep it off the read path
+            self._spawn(self._record_cache_hit(text_hash))
+            embedding = np.array(result['embedding'])
+            self._remember_embedding(text_hash, embedding)
+            return embedding
+        
+        return None
+    
+    def _text_hash(self, text: str) -> str:
+        """Embedding cache key of a text under the current model.
+        
+        The model name is part of the key, so embeddings cached by a worker
+        still on the old model never match after a switch.
+        """
+        return hashlib.sha256(f"{self.embedding_model_name}\n{text}".encode()).hexdigest()
+    
+    def _remember_embedding(self, text_hash: str, embedding: np.ndarray):
+        """Keep an embedding in the in-process LRU"""
+        if self.embedding_lru_size <= 0:
+            return
+        
+        self._embedding_lru[text_hash] = embedding
+        self._embedding_lru.move_to_end(text_hash)
+        while len(self._embedding_lru) > self.embedding_lru_size:
+            self._embedding_lru.popitem(last=False)
+    
+    async def _record_cache_hit(self, text_hash: str):
+        """Bump the hit count of a cached embedding on the primary"""
+        async with self._write_conn() as conn:
+            await self.statements.run(
+                conn, 'execute', 'cache_hit', (),
+                lambda: """
                 UPDATE embedding_cache 
                 SET hit_count = hit_count + 1, 
                     last_accessed = CURRENT_TIMESTAMP
                 WHERE text_hash = $1
-                RETURNING embedding
                 """,
                 text_hash
             )
-            
-            if result:
-                return np.array(result['embedding'])
-        
-        return None
     
     async def _cache_embedding(self, text: str, embedding: np.ndarray):
         """Cache embedding for future use"""
         if not self.use_cache:
             return
         
-        text_hash = hashlib.sha256(text.encode()).hexdigest()
+        text_hash = self._text_hash(text)
+        self._remember_embedding(text_hash, embedding)
         
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                """
+        if self.storage is not None:
+            await self.storage.cache_embedding(text_hash, text, embedding)
+            return
+        
+        async with self._write_conn() as conn:
+            await self.statements.run(
+                conn, 'execute', 'cache_insert', (),
+                lambda: """
                 INSERT INTO embedding_cache (text_hash, text, embedding)
                 VALUES ($1, $2, $3)
                 ON CONFLICT (text_hash) DO UPDATE
@@ -125,126 +739,1450 @@ class PostgresRAG:
                 text_hash, text, embedding.tolist()
             )
     
-    async def generate_embedding(self, text: str) -> np.ndarray:
+    async def generate_embedding(self, text: str, bounded: bool = True) -> np.ndarray:
         """Generate embedding with caching"""
+        await self._wait_for_model()
+        
         # Check cache first
         cached = await self._get_cached_embedding(text)
         if cached is not None:
             return cached
         
-        # Generate new embedding
-        embedding = self.embedding_model.encode(text)
+        # Generate new embedding off the event loop, within the stage's limits
+        async with self.limiters['embedding'].slot(bounded):
+            loop = asyncio.get_running_loop()
+            embedding = await loop.run_in_executor(None, self.embedding_model.encode, text)
         
         # Cache it
         await self._cache_embedding(text, embedding)
         
         return embedding
     
+    def check_embedding_parity(
+        self,
+        texts: Optional[List[str]] = None,
+        min_cosine: float = 0.99
+    ) -> Dict:
+        """Compare the backend's embeddings with the fp32 reference model"""
+        texts = texts or [
+            "PostgreSQL is a powerful open source relational database.",
+            "pgvector adds vector similarity search to PostgreSQL.",
+            "Retrieval-augmented generation grounds answers in documents.",
+            "El agua subterránea se modela con métodos numéricos."
+        ]
+        
+        if self.inference_backend == "torch":
+            parity = {'min_cosine': 1.0, 'mean_cosine': 1.0}
+        else:
+            reference = SentenceTransformer(self.embedding_model_name)
+            parity = embedding_parity(reference, self.embedding_model, texts)
+        
+        parity.update({
+            'backend': self.inference_backend,
+            'passed': parity['min_cosine'] >= min_cosine
+        })
+        logger.info(f"Embedding parity: {parity}")
+        return parity
+    
     async def add_documents(
         self, 
         documents: List[Dict[str, any]], 
-        batch_size: int = 100
+        batch_size: int = 100,
+        collection: str = DEFAULT_COLLECTION
     ) -> int:
         """Add documents to the database with embeddings"""
         total_chunks = 0
         
+        if self.storage is None and collection not in self.collections:
+            await self.create_collection(collection)
+        
+        async def insert(chunks_data):
+            async with self._write_conn() as conn:
+                await self._insert_chunks(conn, chunks_data, collection)
+        
         for i in range(0, len(documents), batch_size):
             batch = documents[i:i + batch_size]
-            chunks_data = []
-            
-            for doc in batch:
-                text = doc.get('content', '')
-                metadata = doc.get('metadata', {})
-                
-                # Chunk the document
-                chunks = self.chunk_text(text)
-                
-                for chunk_idx, chunk in enumerate(chunks):
-                    # Generate embedding
-                    embedding = await self.generate_embedding(chunk)
-                    
-                    chunk_metadata = {
-                        **metadata,
-                        'chunk_index': chunk_idx,
-                        'total_chunks': len(chunks),
-                        'source_doc_id': doc.get('id', 'unknown')
-                    }
-                    
-                    chunks_data.append((chunk, embedding.tolist(), json.dumps(chunk_metadata)))
             
             # Batch insert
-            async with self.pool.acquire() as conn:
-                await conn.executemany(
-                    """
-                    INSERT INTO documents (content, embedding, metadata)
-                    VALUES ($1, $2, $3)
-                    """,
-                    chunks_data
-                )
+            if self.storage is not None:
+                chunks_data = await self._embed_documents(batch)
+                await self.storage.add_chunks(collection, chunks_data)
+            else:
+                chunks_data, _ = await self._with_current_model(lambda: self._embed_documents(batch), insert)
             
             total_chunks += len(chunks_data)
             logger.info(f"Added {len(chunks_data)} chunks from batch {i//batch_size + 1}")
         
         return total_chunks
     
-    async def search(
-        self, 
-        query: str, 
-        top_k: int = 5,
-        metadata_filter: Optional[Dict] = None
-    ) -> List[Dict]:
-        """Search for similar documents"""
+    async def replace_documents(
+        self,
+        metadata_filter: Dict,
+        documents: List[Dict[str, any]],
+        collection: str = DEFAULT_COLLECTION
+    ) -> Tuple[int, int]:
+        """Replace the chunks matching `metadata_filter` by `documents`, atomically.
+        
+        Every chunk is embedded first; the delete and the inserts then run in
+        one transaction, so searches see either the old or the new version
+        and a failure leaves the old one in place. Returns (deleted, added).
+        """
+        if not metadata_filter:
+            raise ValueError("replace_documents requires a non-empty metadata_filter")
+        
+        if self.storage is None and collection not in self.collections:
+            await self.create_collection(collection)
+        
+        if self.storage is not None:
+            chunks_data = await self._embed_documents(documents)
+            deleted = await self.storage.delete(metadata_filter, collection)
+            await self.storage.add_chunks(collection, chunks_data)
+        else:
+            chunks_data, deleted = await self._with_current_model(
+                lambda: self._embed_documents(documents),
+                lambda chunks_data: self._replace_chunks(metadata_filter, chunks_data, collection)
+            )
+        
+        logger.info(f"Replaced {deleted} chunks matching {metadata_filter} by {len(chunks_data)}")
+        return deleted, len(chunks_data)
+    
+    async def _replace_chunks(self, metadata_filter: Dict, chunks_data: List[Tuple], collection: str) -> int:
+        """Delete the matching chunks and insert new ones in one transaction"""
+        conditions, params = self._scope_conditions(collection, metadata_filter, 1)
+        
+        async with self._write_conn() as conn:
+            async with conn.transaction():
+                status = await conn.execute(
+                    f"DELETE FROM documents WHERE {' AND '.join(conditions)}", *params
+                )
+                await self._insert_chunks(conn, chunks_data, collection)
+        
+        return int(status.split()[-1])
+    
+    async def _embed_documents(self, documents: List[Dict[str, any]]) -> List[Tuple]:
+        """Chunk and embed documents into (chunk, embedding, metadata) rows"""
+        chunks_data = []
+        
+        for doc in documents:
+            text = doc.get('content', '')
+            metadata = doc.get('metadata', {})
+            
+            # Chunk the document
+            chunks = self.chunk_text(text)
+            
+            for chunk_idx, chunk in enumerate(chunks):
+                # Generate embedding (ingestion waits for a slot rather
+                # than being shed halfway through a batch)
+                embedding = await self.generate_embedding(chunk, bounded=False)
+                
+                chunk_metadata = {
+                    **metadata,
+                    'chunk_index': chunk_idx,
+                    'total_chunks': len(chunks),
+                    'source_doc_id': doc.get('id', 'unknown')
+                }
+                
+                chunks_data.append((chunk, embedding, chunk_metadata))
+        
+        return chunks_data
+    
+    async def _with_current_model(self, embed: Callable[[], Awaitable], operation: Callable[..., Awaitable]) -> Tuple:
+        """Run `operation` on what `embed` returns, embedding again if the model switched meanwhile"""
+        embedded = await embed()
+        try:
+            return embedded, await operation(embedded)
+        except asyncpg.exceptions.DataError:
+            # Embedded just before a worker switched the embedding model
+            if not await self._follow_active_model():
+                raise
+            embedded = await embed()
+            return embedded, await operation(embedded)
+    
+    @staticmethod
+    async def _insert_chunks(conn, chunks_data: List[Tuple], collection: str):
+        """Insert (chunk, embedding, metadata) rows into a collection"""
+        await conn.executemany(
+            """
+            INSERT INTO documents (content, embedding, metadata, collection)
+            VALUES ($1, $2, $3, $4)
+            """,
+            [
+                (chunk, embedding.tolist(), json.dumps(chunk_metadata), collection)
+                for chunk, embedding, chunk_metadata in chunks_data
+            ]
+        )
+    
+    async def export_snapshot(
+        self,
+        path: str,
+        collection: Optional[str] = None,
+        batch_size: int = 5000
+    ) -> Dict:
+        """Dump chunks, metadata and embeddings of one or all collections to a snapshot.
+        
+        Rows are streamed with a server-side cursor inside a repeatable-read
+        transaction, so the snapshot is consistent while writes continue.
+        """
+        self._require_database("Snapshot export")
         start_time = time.time()
+        conditions, params = self._scope_conditions(collection, None, 1)
+        where = " AND ".join(["embedding IS NOT NULL"] + conditions)
         
-        # Generate query embedding
-        query_embedding = await self.generate_embedding(query)
+        async with self._read_conn() as conn:
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                counts = await conn.fetchrow(
+                    f"SELECT COUNT(*) AS count, MAX(vector_dims(embedding)) AS dim FROM documents WHERE {where}",
+                    *params
+                )
+                writer = SnapshotWriter(path, counts['count'], counts['dim'] or self.embedding_dim or 0)
+                
+                rows = []
+                async for row in conn.cursor(
+                    f"SELECT id, collection, content, metadata, embedding FROM documents WHERE {where} ORDER BY collection, id",
+                    *params,
+                    prefetch=batch_size
+                ):
+                    rows.append(row)
+                    if len(rows) == batch_size:
+                        writer.append(rows)
+                        rows = []
+                if rows:
+                    writer.append(rows)
         
-        # Build query with optional metadata filter
-        sql_query = """
+        manifest = writer.close(embedding_model=self.embedding_model_name)
+        logger.info(
+            f"Exported {manifest['count']} chunks to {path} in {time.time() - start_time:.1f}s"
+        )
+        return manifest
+    
+    async def import_snapshot(
+        self,
+        path: str,
+        collection: Optional[str] = None,
+        batch_size: int = 5000,
+        rebuild_indexes: bool = True
+    ) -> int:
+        """Bulk-load a snapshot with COPY, reusing its embeddings (no inference).
+        
+        Rows keep their collections unless `collection` is given, in which
+        case everything goes there. ANN indexes are rebuilt afterwards, sized
+        for the loaded rows.
+        """
+        self._require_database("Snapshot import")
+        start_time = time.time()
+        snapshot = Snapshot(path)
+        manifest = snapshot.manifest
+        
+        if manifest['embedding_model'] != self.embedding_model_name:
+            raise ValueError(
+                f"Snapshot embeddings come from {manifest['embedding_model']}, not {self.embedding_model_name}"
+            )
+        if self.embedding_dim is None:
+            self.embedding_dim = manifest['dim']
+        elif len(snapshot) and manifest['dim'] != self.embedding_dim:
+            raise ValueError(f"Snapshot dimension {manifest['dim']} does not match {self.embedding_dim}")
+        
+        targets = [collection] if collection else snapshot.collections
+        for target in targets:
+            if target not in self.collections:
+                await self.create_collection(target)
+        
+        async with self._write_conn() as conn:
+            async with conn.transaction():
+                for batch in snapshot.batches(batch_size):
+                    # Already in pgvector's byte order, so the codec does not copy
+                    embeddings = np.asarray(batch['embedding'], dtype='>f4')
+                    collections = [collection] * len(embeddings) if collection else batch['collection']
+                    await conn.copy_records_to_table(
+                        'documents',
+                        records=zip(collections, batch['content'], batch['metadata'], embeddings),
+                        columns=['collection', 'content', 'metadata', 'embedding']
+                    )
+        
+        if rebuild_indexes and len(snapshot):
+            for target in targets:
+                await self.rebuild_collection_index(target)
+        
+        logger.info(f"Imported {len(snapshot)} chunks from {path} in {time.time() - start_time:.1f}s")
+        return len(snapshot)
+    
+    async def delete_documents(
+        self,
+        metadata_filter: Dict,
+        collection: Optional[str] = DEFAULT_COLLECTION
+    ) -> int:
+        """Delete the chunks whose metadata contains `metadata_filter`"""
+        if not metadata_filter:
+            raise ValueError("delete_documents requires a non-empty metadata_filter")
+        
+        if self.storage is not None:
+            deleted = await self.storage.delete(metadata_filter, collection)
+            logger.info(f"Deleted {deleted} chunks matching {metadata_filter}")
+            return deleted
+        
+        conditions, params = self._scope_conditions(collection, metadata_filter, 1)
+        
+        async with self._write_conn() as conn:
+            status = await conn.execute(
+                f"DELETE FROM documents WHERE {' AND '.join(conditions)}", *params
+            )
+        
+        deleted = int(status.split()[-1])
+        logger.info(f"Deleted {deleted} chunks matching {metadata_filter}")
+        return deleted
+    
+    @staticmethod
+    def _filter_key(metadata_filter: Dict) -> str:
+        """Canonical JSON form of a metadata filter"""
+        return json.dumps(metadata_filter, sort_keys=True)
+    
+    @staticmethod
+    def _partition_name(collection: str) -> str:
+        """Name of the documents partition holding a collection"""
+        if not COLLECTION_NAME_RE.match(collection):
+            raise ValueError(
+                f"Invalid collection name {collection!r}: use 1-48 lowercase letters, digits or underscores"
+            )
+        return f"documents_{collection}"
+    
+    def _index_definition(self, column: str = "embedding", dim: Optional[int] = None) -> str:
+        """Indexed expression and operator class for the storage mode"""
+        dim = dim or self.embedding_dim
+        if self.vector_storage == "halfvec":
+            return f"({column}::halfvec({dim})) halfvec_cosine_ops"
+        if self.vector_storage == "binary":
+            return f"(binary_quantize({column})::bit({dim})) bit_hamming_ops"
+        return f"{column} vector_cosine_ops"
+    
+    def _ann_distance(self) -> str:
+        """ORDER BY expression served by the ANN index for query vector $1"""
+        if self.vector_storage == "halfvec":
+            return f"embedding::halfvec({self.embedding_dim}) <=> $1::vector::halfvec({self.embedding_dim})"
+        if self.vector_storage == "binary":
+            return f"binary_quantize(embedding)::bit({self.embedding_dim}) <~> binary_quantize($1::vector)"
+        return "embedding <=> $1::vector"
+    
+    def _ann_sql(self, where: str, limit: str) -> str:
+        """ANN query, re-ranked by exact distance when the index is compact"""
+        if self.vector_storage == "full":
+            return f"""
+                SELECT 
+                    id,
+                    content,
+                    metadata,
+                    embedding,
+                    1 - (embedding <=> $1::vector) as similarity
+                FROM documents
+                {where}
+                ORDER BY embedding <=> $1::vector
+                LIMIT {limit}
+                """
+        
+        return f"""
+            WITH candidates AS MATERIALIZED (
+                SELECT id, content, metadata, embedding
+                FROM documents
+                {where}
+                ORDER BY {self._ann_distance()}
+                LIMIT {limit} * {int(self.rerank_factor)}
+            )
             SELECT 
                 id,
                 content,
                 metadata,
+                embedding,
                 1 - (embedding <=> $1::vector) as similarity
+            FROM candidates
+            ORDER BY embedding <=> $1::vector
+            LIMIT {limit}
+            """
+    
+    async def _check_schema(self):
+        """Fail fast when the database was created by an older init.sql"""
+        async with self._write_conn() as conn:
+            schema = await conn.fetchrow(
+                """
+                SELECT
+                    (SELECT relkind::text FROM pg_class WHERE oid = to_regclass('documents')) AS documents_kind,
+                    to_regclass('collections') IS NOT NULL AS has_collections,
+                    to_regclass('filtered_indexes') IS NOT NULL AS has_filtered_indexes,
+                    to_regclass('embedding_model') IS NOT NULL AND to_regclass('reembed_jobs') IS NOT NULL
+                        AS has_model_tables
+                """
+            )
+        
+        problems = []
+        if schema['documents_kind'] != 'p':
+            problems.append("documents is not partitioned by collection")
+        if not schema['has_collections']:
+            problems.append("the collections table is missing")
+        if not schema['has_filtered_indexes']:
+            problems.append("the filtered_indexes table is missing")
+        if not schema['has_model_tables']:
+            problems.append("the embedding_model and reembed_jobs tables are missing")
+        
+        if problems:
+            raise RuntimeError(
+                f"Database schema is out of date ({'; '.join(problems)}). "
+                "Run upgrade.sql against it once, see 'Upgrading an existing database' in the README"
+            )
+    
+    async def _load_collections(self):
+        """Load the names of the existing collections"""
+        async with self._write_conn() as conn:
+            rows = await conn.fetch("SELECT name FROM collections")
+        
+        self.collections = {r['name'] for r in rows}
+    
+    async def _read_active_model(self):
+        """Take the model name and dimension of the stored vectors without loading the model"""
+        async with self._write_conn() as conn:
+            active = await conn.fetchrow("SELECT name, dimension FROM embedding_model")
+        if active is not None:
+            self.embedding_model_name = active['name']
+            self.embedding_dim = active['dimension']
+    
+    async def _follow_active_model(self) -> bool:
+        """Switch to the embedding model recorded in the database.
+        
+        Returns True when this worker switched, i.e. when embeddings it
+        computed before the call may no longer match the stored vectors.
+        """
+        async with self._model_lock:
+            async with self._write_conn() as conn:
+                active = await conn.fetchrow("SELECT name, dimension, generation FROM embedding_model")
+                if active is None:
+                    # Upgraded database: the first worker records its model
+                    await conn.execute(
+                        "INSERT INTO embedding_model (name, dimension) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING",
+                        self.embedding_model_name, self.embedding_dim
+                    )
+                    active = await conn.fetchrow("SELECT name, dimension, generation FROM embedding_model")
+                column_dim = await conn.fetchval(
+                    "SELECT atttypmod FROM pg_attribute WHERE attrelid = 'documents'::regclass AND attname = 'embedding'"
+                )
+            
+            if active['generation'] == self._model_generation:
+                return False
+            switched = self._model_generation is not None
+            
+            if active['name'] != self.embedding_model_name:
+                if self._prepared_model and self._prepared_model[0] == active['name']:
+                    _, model, dim = self._prepared_model
+                else:
+                    logger.warning(f"Loading {active['name']}, the embedding model the stored vectors come from")
+                    loop = asyncio.get_running_loop()
+                    model, dim = await loop.run_in_executor(None, self._load_embedding_model, active['name'])
+                self.embedding_model = model
+                self.embedding_model_name = active['name']
+                self.embedding_dim = dim
+                self._embedding_lru.clear()
+            
+            self._prepared_model = None
+            self._model_generation = active['generation']
+            if column_dim != self.embedding_dim:
+                logger.error(
+                    f"documents.embedding holds {column_dim}-dimensional vectors but {self.embedding_model_name} "
+                    f"produces {self.embedding_dim}"
+                )
+            
+            if switched:
+                self.statements.clear()
+                # Pooled connections hold prepared statements for the old column types
+                for pool in [self.pool] + self.read_pools:
+                    await pool.expire_connections()
+                logger.info(f"Switched to embedding model {self.embedding_model_name}")
+            if self._listener is not None:
+                await self._listener.execute(
+                    "SELECT set_config('application_name', $1, false)", WORKER_APPLICATION_NAME
+                )
+            return switched
+    
+    async def _wait_for_model(self):
+        """Wait while a model switch is being committed"""
+        if self._model_ready.is_set():
+            return
+        
+        try:
+            await asyncio.wait_for(self._model_ready.wait(), MODEL_SWITCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Never heard how the switch ended, go by what the database says
+            logger.warning(f"No word on the model switch after {MODEL_SWITCH_TIMEOUT}s")
+            await self._follow_active_model()
+            self._model_ready.set()
+    
+    async def _listen_for_model_switches(self):
+        """Follow model switches announced by a re-embedding job in any worker"""
+        self._listener = await asyncpg.connect(
+            host=self.db_config.get('host', 'localhost'),
+            port=self.db_config.get('port', 5432),
+            user=self.db_config['user'],
+            password=self.db_config['password'],
+            database=self.db_config['database'],
+            server_settings={'application_name': WORKER_APPLICATION_NAME}
+        )
+        await self._listener.add_listener(MODEL_SWITCH_CHANNEL, self._on_model_switch)
+        
+        # Started while a job runs: load its model now, like the other workers did
+        job = await self.reembed_status()
+        if job['state'] not in ('idle', 'interrupted') + REEMBED_DONE_STATES:
+            self._spawn(self._prepare_model(job['embedding_model']))
+    
+    def _on_model_switch(self, conn, pid, channel, payload):
+        """asyncpg listener callback for MODEL_SWITCH_CHANNEL"""
+        event = json.loads(payload)
+        self._spawn(self._handle_model_switch(event['event'], event['model']))
+    
+    async def _handle_model_switch(self, event: str, model_name: str):
+        """React to one step of a model switch announced by the re-embedding job"""
+        if event == 'prepare':
+            await self._prepare_model(model_name)
+        elif event == 'switching':
+            # Queries embedded with the old model would not match the new column
+            self._model_ready.clear()
+        elif event == 'switched':
+            await self._follow_active_model()
+            self._model_ready.set()
+        elif event == 'aborted':
+            self._prepared_model = None
+            self._model_ready.set()
+    
+    @staticmethod
+    def _prepared_application_name(model_name: str) -> str:
+        """application_name of a worker that has loaded `model_name` (kept under 64 bytes)"""
+        return f"{WORKER_APPLICATION_NAME} prepared {hashlib.sha256(model_name.encode()).hexdigest()[:16]}"
+    
+    async def _prepare_model(self, model_name: str):
+        """Load the model a running job switches to, so the switch itself is quick"""
+        async with self._model_lock:
+            if not (self._prepared_model and self._prepared_model[0] == model_name):
+                loop = asyncio.get_running_loop()
+                model, dim = await loop.run_in_executor(None, self._load_embedding_model, model_name)
+                self._prepared_model = (model_name, model, dim)
+            
+            if self._listener is not None:
+                await self._listener.execute(
+                    "SELECT set_config('application_name', $1, false)", self._prepared_application_name(model_name)
+                )
+    
+    async def create_collection(self, collection: str, lists: int = 100):
+        """Create the documents partition and ANN index for a collection"""
+        self._require_database("Creating collections")
+        partition = self._partition_name(collection)
+        
+        async with self._write_conn() as conn:
+            ddl = await conn.fetchval(
+                "SELECT format('CREATE TABLE IF NOT EXISTS %I PARTITION OF documents FOR VALUES IN (%L)', $1::text, $2::text)",
+                partition, collection
+            )
+            await conn.execute(ddl)
+            ddl = await conn.fetchval(
+                """
+                SELECT format(
+                    'CREATE INDEX IF NOT EXISTS %I ON %I USING ivfflat (%s) WITH (lists = %s)',
+                    $1::text, $2::text, $3::text, $4::int
+                )
+                """,
+                f"idx_{partition}_embedding", partition, self._index_definition(), lists
+            )
+            await conn.execute(ddl)
+            await conn.execute(
+                """
+                INSERT INTO collections (name, partition_name)
+                VALUES ($1, $2)
+                ON CONFLICT (name) DO NOTHING
+                """,
+                collection, partition
+            )
+        
+        self.collections.add(collection)
+        logger.info(f"Collection {collection} ready in partition {partition}")
+    
+    @staticmethod
+    def _ivfflat_lists(rows: int) -> int:
+        """pgvector guidance: rows / 1000 up to 1M rows, sqrt(rows) above"""
+        return max(1, rows // 1000 if rows <= 1_000_000 else int(rows ** 0.5))
+    
+    @staticmethod
+    async def _execute_ddl(conn, template: str, *args):
+        """Run DDL built server-side with format(), so identifiers are quoted"""
+        ddl = await conn.fetchval("SELECT format($1::text, VARIADIC $2::text[])", template, [str(a) for a in args])
+        await conn.execute(ddl)
+    
+    async def rebuild_collection_index(self, collection: str, lists: Optional[int] = None) -> int:
+        """Rebuild the ANN index of one collection without locking the others.
+        
+        The new index is built concurrently next to the old one and swapped in,
+        so searches on this collection keep being served during the rebuild.
+        When `lists` is not given it is sized from the partition's row count.
+        The index is built for the current `vector_storage` mode, so this is
+        also how a collection is switched between full and compact indexes.
+        """
+        self._require_database("Rebuilding indexes")
+        partition = self._partition_name(collection)
+        index_name = f"idx_{partition}_embedding"
+        
+        async with self._write_conn() as conn:
+            if lists is None:
+                rows = await conn.fetchval(
+                    "SELECT COUNT(*) FROM documents WHERE collection = $1", collection
+                )
+                lists = self._ivfflat_lists(rows)
+            
+            statements = [
+                ("DROP INDEX CONCURRENTLY IF EXISTS %I", [f"{index_name}_rebuild"]),
+                (
+                    "CREATE INDEX CONCURRENTLY %I ON %I USING ivfflat (%s) WITH (lists = %s)",
+                    [f"{index_name}_rebuild", partition, self._index_definition(), str(lists)]
+                ),
+                ("DROP INDEX CONCURRENTLY IF EXISTS %I", [index_name]),
+                ("ALTER INDEX %I RENAME TO %I", [f"{index_name}_rebuild", index_name]),
+            ]
+            for template, args in statements:
+                await self._execute_ddl(conn, template, *args)
+        
+        logger.info(f"Rebuilt ANN index of collection {collection} with {lists} lists")
+        return lists
+    
+    async def _pending_reembed_rows(self, conn, limit: Optional[int], after: Tuple = ('', 0)) -> List:
+        """Rows after a (collection, id) keyset position still lacking `embedding_next`"""
+        return await conn.fetch(
+            """
+            SELECT collection, id, content
             FROM documents
+            WHERE (collection, id) > ($1, $2) AND embedding_next IS NULL
+            ORDER BY collection, id
+            LIMIT $3
+            """,
+            after[0], after[1], limit
+        )
+    
+    async def _reembed_rows(self, conn, rows: List, model) -> None:
+        """Embed rows with the new model and store them in `embedding_next`"""
+        async with self.limiters['embedding'].slot(bounded=False):
+            loop = asyncio.get_running_loop()
+            embeddings = await loop.run_in_executor(None, model.encode, [r['content'] for r in rows])
+        
+        await conn.executemany(
+            "UPDATE documents SET embedding_next = $3 WHERE collection = $1 AND id = $2",
+            [(r['collection'], r['id'], embedding) for r, embedding in zip(rows, embeddings)]
+        )
+        self.metrics['reembedded_rows'] += len(rows)
+    
+    @staticmethod
+    async def _update_reembed_job(conn, job_id: int, **fields):
+        """Record a re-embedding job's progress where every worker can read it"""
+        assignments = ", ".join(f"{column} = ${i}" for i, column in enumerate(fields, 2))
+        await conn.execute(
+            f"UPDATE reembed_jobs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = $1",
+            job_id, *fields.values()
+        )
+    
+    @staticmethod
+    async def _notify_model_switch(conn, event: str, model_name: str):
+        """Announce a step of a model switch to every worker"""
+        await conn.execute(
+            "SELECT pg_notify($1, $2)", MODEL_SWITCH_CHANNEL, json.dumps({'event': event, 'model': model_name})
+        )
+    
+    async def _wait_for_prepared_workers(self, conn, model_name: str, timeout: float) -> int:
+        """Wait until every listening worker has loaded `model_name`; returns how many have not"""
+        deadline = time.time() + timeout
+        while True:
+            pending = await conn.fetchval(
+                """
+                SELECT COUNT(*) FROM pg_stat_activity
+                WHERE datname = current_database()
+                  AND application_name LIKE $1 || '%' AND application_name <> $2
+                """,
+                WORKER_APPLICATION_NAME, self._prepared_application_name(model_name)
+            )
+            if not pending or time.time() > deadline:
+                return pending
+            await asyncio.sleep(1)
+    
+    async def reembed_status(self) -> Dict:
+        """State and throughput of the running or last re-embedding job, from any worker"""
+        if self.storage is not None:
+            return {'state': 'idle'}
+        
+        async with self._write_conn() as conn:
+            job = await conn.fetchrow(
+                """
+                SELECT j.*,
+                    EXTRACT(EPOCH FROM j.updated_at - j.started_at)::float AS elapsed_seconds,
+                    EXISTS (
+                        SELECT 1 FROM pg_locks
+                        WHERE locktype = 'advisory' AND classid = $1::int::oid AND objid = $2::int::oid AND objsubid = 2
+                    ) AS locked
+                FROM reembed_jobs j
+                ORDER BY j.id DESC
+                LIMIT 1
+                """,
+                *REEMBED_LOCK
+            )
+        
+        if job is None:
+            return {'state': 'idle'}
+        
+        status = {
+            'job_id': job['id'],
+            'state': job['state'],
+            'embedding_model': job['embedding_model'],
+            'rows_total': job['rows_total'],
+            'rows_done': job['rows_done'],
+            'rows_per_second': job['rows_per_second'],
+            'started_at': job['started_at'].isoformat(),
+            'elapsed_seconds': round(job['elapsed_seconds'], 1)
+        }
+        if job['state'] not in REEMBED_DONE_STATES and not job['locked']:
+            # The process running it died; starting the job again resumes it
+            status['state'] = 'interrupted'
+        if job['failed_while']:
+            status.update({'failed_while': job['failed_while'], 'error': job['error']})
+        return status
+    
+    async def start_reembed(
+        self,
+        embedding_model_name: str,
+        batch_size: int = 256,
+        max_rows_per_second: Optional[float] = None,
+        worker_timeout: float = 300.0
+    ) -> asyncio.Task:
+        """Claim the re-embedding job and run it in the background (see reembed).
+        
+        At most one job runs across all workers: the job holds an advisory
+        lock on its own connection until it ends (or its process dies), and
+        RuntimeError is raised here while another one holds it.
         """
+        self._require_database("Re-embedding")
+        
+        conn = await self.pool.acquire(timeout=self.acquire_timeout)
+        try:
+            if not await conn.fetchval("SELECT pg_try_advisory_lock($1, $2)", *REEMBED_LOCK):
+                raise RuntimeError("A re-embedding job is already running")
+            job_id = await conn.fetchval(
+                "INSERT INTO reembed_jobs (embedding_model, state) VALUES ($1, 'loading_model') RETURNING id",
+                embedding_model_name
+            )
+        except Exception:
+            # Resetting the connection on release also drops the advisory lock
+            await self.pool.release(conn)
+            raise
         
-        params = [query_embedding.tolist()]
+        self._reembed_task = asyncio.ensure_future(
+            self._run_reembed(conn, job_id, embedding_model_name, batch_size, max_rows_per_second, worker_timeout)
+        )
+        return self._reembed_task
+    
+    async def reembed(
+        self,
+        embedding_model_name: str,
+        batch_size: int = 256,
+        max_rows_per_second: Optional[float] = None,
+        worker_timeout: float = 300.0
+    ) -> Dict:
+        """Re-embed every chunk with a new embedding model and return the job's final status"""
+        task = await self.start_reembed(embedding_model_name, batch_size, max_rows_per_second, worker_timeout)
+        await task
+        return await self.reembed_status()
+    
+    async def _run_reembed(
+        self,
+        conn,
+        job_id: int,
+        embedding_model_name: str,
+        batch_size: int,
+        max_rows_per_second: Optional[float],
+        worker_timeout: float
+    ):
+        """Body of a re-embedding job; `conn` holds the job's advisory lock"""
+        start_time = time.time()
+        state = 'loading_model'
+        rows_done = 0
+        
+        async def embed(rows):
+            nonlocal rows_done
+            await self._reembed_rows(conn, rows, model)
+            rows_done += len(rows)
+            await self._update_reembed_job(
+                conn, job_id,
+                rows_done=rows_done,
+                rows_per_second=round(rows_done / max(time.time() - start_time, 1e-9), 1)
+            )
+        
+        try:
+            loop = asyncio.get_running_loop()
+            model, dim = await loop.run_in_executor(None, self._load_embedding_model, embedding_model_name)
+            self._prepared_model = (embedding_model_name, model, dim)
+            await self._notify_model_switch(conn, 'prepare', embedding_model_name)
+            
+            column_type = await conn.fetchval(
+                """
+                SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+                WHERE attrelid = 'documents'::regclass AND attname = 'embedding_next' AND NOT attisdropped
+                """
+            )
+            if column_type is not None and column_type != f"vector({dim})":
+                await conn.execute("ALTER TABLE documents DROP COLUMN embedding_next")
+            await conn.execute(f"ALTER TABLE documents ADD COLUMN IF NOT EXISTS embedding_next vector({int(dim)})")
+            
+            state = 'embedding'
+            await self._update_reembed_job(
+                conn, job_id, state=state, rows_total=await conn.fetchval("SELECT COUNT(*) FROM documents")
+            )
+            position = ('', 0)
+            while True:
+                rows = await self._pending_reembed_rows(conn, batch_size, position)
+                if not rows:
+                    break
+                await embed(rows)
+                position = (rows[-1]['collection'], rows[-1]['id'])
+                
+                if max_rows_per_second:
+                    delay = rows_done / max_rows_per_second - (time.time() - start_time)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+            
+            state = 'indexing'
+            await self._update_reembed_job(conn, job_id, state=state)
+            collections = await conn.fetch("SELECT name, partition_name FROM collections")
+            filtered = await conn.fetch("SELECT collection, index_name, predicate FROM filtered_indexes")
+            indexes = []
+            for c in collections:
+                rows = await conn.fetchval("SELECT COUNT(*) FROM documents WHERE collection = $1", c['name'])
+                indexes.append((f"idx_{c['partition_name']}_embedding", c['partition_name'], rows, None))
+            for f in filtered:
+                rows = await conn.fetchval(
+                    f"SELECT COUNT(*) FROM documents WHERE collection = $1 AND {f['predicate']}", f['collection']
+                )
+                indexes.append((f['index_name'], self._partition_name(f['collection']), rows, f['predicate']))
+            
+            for index_name, partition, rows, predicate in indexes:
+                await self._execute_ddl(conn, "DROP INDEX CONCURRENTLY IF EXISTS %I", f"{index_name}_next")
+                await self._execute_ddl(
+                    conn,
+                    "CREATE INDEX CONCURRENTLY %I ON %I USING ivfflat (%s) WITH (lists = %s)"
+                    + (" WHERE %s" if predicate else ""),
+                    f"{index_name}_next", partition, self._index_definition('embedding_next', dim),
+                    self._ivfflat_lists(rows), *([predicate] if predicate else [])
+                )
+            
+            # Built now that nearly every row is filled in, these stay small
+            pending_indexes = [f"idx_{c['partition_name']}_reembed" for c in collections]
+            for index_name, c in zip(pending_indexes, collections):
+                await self._execute_ddl(conn, "DROP INDEX CONCURRENTLY IF EXISTS %I", index_name)
+                await self._execute_ddl(
+                    conn,
+                    "CREATE INDEX CONCURRENTLY %I ON %I (collection, id) WHERE embedding_next IS NULL",
+                    index_name, c['partition_name']
+                )
+            
+            # Rows inserted while embedding or indexing
+            state = 'catching_up'
+            await self._update_reembed_job(conn, job_id, state=state)
+            while True:
+                rows = await self._pending_reembed_rows(conn, batch_size)
+                if rows:
+                    await embed(rows)
+                if len(rows) < batch_size:
+                    break
+            
+            unprepared = await self._wait_for_prepared_workers(conn, embedding_model_name, worker_timeout)
+            if unprepared:
+                logger.warning(f"{unprepared} worker(s) will load {embedding_model_name} only after the switch")
+            
+            state = 'switching'
+            await self._update_reembed_job(conn, job_id, state=state)
+            async with conn.transaction():
+                await conn.execute("SET LOCAL lock_timeout = '10s'")
+                # Writes wait from here on; searches keep running until the renames
+                await conn.execute("LOCK TABLE documents IN SHARE ROW EXCLUSIVE MODE")
+                rows = await self._pending_reembed_rows(conn, None)
+                if rows:
+                    await embed(rows)
+                
+                # Sent right away (a NOTIFY in this transaction would wait for the commit)
+                async with self._write_conn() as other:
+                    await self._notify_model_switch(other, 'switching', embedding_model_name)
+                self._model_ready.clear()
+                
+                for index_name in pending_indexes:
+                    await self._execute_ddl(conn, "DROP INDEX IF EXISTS %I", index_name)
+                # Dropping the old column drops its indexes too
+                await conn.execute("ALTER TABLE documents RENAME COLUMN embedding TO embedding_old")
+                await conn.execute("ALTER TABLE documents RENAME COLUMN embedding_next TO embedding")
+                await conn.execute("ALTER TABLE documents DROP COLUMN embedding_old")
+                for index_name, _, _, _ in indexes:
+                    await self._execute_ddl(conn, "ALTER INDEX %I RENAME TO %I", f"{index_name}_next", index_name)
+                
+                # Collections and filtered indexes created while the job ran
+                # are small, index them here
+                late = [
+                    (f"idx_{c['partition_name']}_embedding", c['partition_name'], c['name'], None)
+                    for c in await conn.fetch("SELECT name, partition_name FROM collections")
+                ] + [
+                    (f['index_name'], self._partition_name(f['collection']), f['collection'], f['predicate'])
+                    for f in await conn.fetch("SELECT collection, index_name, predicate FROM filtered_indexes")
+                ]
+                indexed = {index_name for index_name, _, _, _ in indexes}
+                for index_name, partition, collection, predicate in late:
+                    if index_name in indexed:
+                        continue
+                    rows = await conn.fetchval(
+                        "SELECT COUNT(*) FROM documents WHERE collection = $1"
+                        + (f" AND {predicate}" if predicate else ""),
+                        collection
+                    )
+                    await self._execute_ddl(
+                        conn,
+                        "CREATE INDEX %I ON %I USING ivfflat (%s) WITH (lists = %s)"
+                        + (" WHERE %s" if predicate else ""),
+                        index_name, partition, self._index_definition('embedding', dim),
+                        self._ivfflat_lists(rows), *([predicate] if predicate else [])
+                    )
+                
+                await conn.execute("TRUNCATE embedding_cache")
+                await conn.execute(f"ALTER TABLE embedding_cache ALTER COLUMN embedding TYPE vector({int(dim)})")
+                await conn.execute(
+                    f"ALTER TABLE search_history DROP COLUMN query_embedding, "
+                    f"ADD COLUMN query_embedding halfvec({int(dim)})"
+                )
+                await conn.execute(
+                    """
+                    INSERT INTO embedding_model (name, dimension) VALUES ($1, $2)
+                    ON CONFLICT (id) DO UPDATE
+                    SET name = EXCLUDED.name,
+                        dimension = EXCLUDED.dimension,
+                        generation = embedding_model.generation + 1,
+                        switched_at = CURRENT_TIMESTAMP
+                    """,
+                    embedding_model_name, dim
+                )
+                state = 'completed'
+                await self._update_reembed_job(conn, job_id, state=state)
+                # Delivered on commit
+                await self._notify_model_switch(conn, 'switched', embedding_model_name)
+        except (Exception, asyncio.CancelledError) as e:
+            outcome = 'cancelled' if isinstance(e, asyncio.CancelledError) else 'failed'
+            logger.error(f"Re-embedding with {embedding_model_name} {outcome} while {state}: {e}")
+            self._prepared_model = None
+            self._model_ready.set()
+            # `conn` may be unusable (e.g. cancelled mid-query), so use another
+            async with self._write_conn() as other:
+                await self._update_reembed_job(
+                    other, job_id, state=outcome, failed_while=state, error=str(e) or outcome
+                )
+                await self._notify_model_switch(other, 'aborted', embedding_model_name)
+            raise
+        else:
+            logger.info(f"Re-embedded {rows_done} chunks with {embedding_model_name}")
+        finally:
+            await self.pool.release(conn)
+        
+        try:
+            if self.embedding_model is not None:
+                await self._follow_active_model()
+        finally:
+            self._prepared_model = None
+            self._model_ready.set()
+    
+    async def _load_filtered_indexes(self):
+        """Load the partial ANN indexes registered for hot metadata filters"""
+        async with self._write_conn() as conn:
+            rows = await conn.fetch("SELECT collection, filter, predicate FROM filtered_indexes")
+        
+        self.filtered_indexes = {
+            (r['collection'], self._filter_key(json.loads(r['filter']))): r['predicate']
+            for r in rows
+        }
+    
+    async def create_filtered_index(
+        self,
+        metadata_filter: Dict,
+        lists: Optional[int] = None,
+        collection: str = DEFAULT_COLLECTION
+    ) -> str:
+        """Build a partial ANN index for a hot metadata filter.
+        
+        Searches in `collection` whose filter equals `metadata_filter` are then
+        served by an index that only holds matching rows, so no candidates are
+        lost to post-filtering. When `lists` is not given it is sized from the
+        number of matching rows.
+        """
+        self._require_database("Creating filtered indexes")
+        partition = self._partition_name(collection)
+        filter_key = self._filter_key(metadata_filter)
+        index_name = f"idx_{partition}_embedding_f_" + hashlib.sha256(filter_key.encode()).hexdigest()[:12]
+        
+        async with self._write_conn() as conn:
+            if lists is None:
+                rows = await conn.fetchval(
+                    "SELECT COUNT(*) FROM documents WHERE collection = $1 AND metadata @> $2::jsonb",
+                    collection, filter_key
+                )
+                lists = self._ivfflat_lists(rows)
+            
+            # Let the server quote the literal so the stored predicate text is
+            # exactly what the planner has to match against the index.
+            predicate = await conn.fetchval(
+                "SELECT format('metadata @> %L::jsonb', $1::text)", filter_key
+            )
+            ddl = await conn.fetchval(
+                """
+                SELECT format(
+                    'CREATE INDEX CONCURRENTLY IF NOT EXISTS %I ON %I '
+                    'USING ivfflat (%s) WITH (lists = %s) WHERE %s',
+                    $1::text, $2::text, $3::text, $4::int, $5::text
+                )
+                """,
+                index_name, partition, self._index_definition(), lists, predicate
+            )
+            await conn.execute(ddl)
+            await conn.execute(
+                """
+                INSERT INTO filtered_indexes (collection, filter, index_name, predicate)
+                VALUES ($1, $2::jsonb, $3, $4)
+                ON CONFLICT (index_name) DO NOTHING
+                """,
+                collection, filter_key, index_name, predicate
+            )
+        
+        self.filtered_indexes[(collection, filter_key)] = predicate
+        logger.info(f"Created filtered index {index_name} for {filter_key}")
+        return index_name
+    
+    @staticmethod
+    def _scope_conditions(
+        collection: Optional[str],
+        metadata_filter: Optional[Dict],
+        first_param: int
+    ) -> Tuple[List[str], List]:
+        """WHERE conditions and parameters for a collection and metadata filter"""
+        conditions, params = [], []
+        
+        # Restricting on the partition key prunes the scan to one partition
+        if collection is not None:
+            params.append(collection)
+            conditions.append(f"collection = ${first_param + len(params) - 1}")
         
         if metadata_filter:
-            sql_query += " WHERE metadata @> $2::jsonb"
             params.append(json.dumps(metadata_filter))
+            conditions.append(f"metadata @> ${first_param + len(params) - 1}::jsonb")
         
-        sql_query += """
+        return conditions, params
+    
+    async def _count_filter_matches(
+        self,
+        conn,
+        metadata_filter: Dict,
+        collection: Optional[str],
+        limit: int
+    ) -> int:
+        """Count rows matching a metadata filter, stopping after `limit` + 1"""
+        conditions, params = self._scope_conditions(collection, metadata_filter, 1)
+        return await self.statements.run(
+            conn, 'fetchval', 'filter_count', (collection is not None,),
+            lambda: f"""
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM documents WHERE {' AND '.join(conditions)} LIMIT ${len(params) + 1}
+            ) AS matches
+            """,
+            *params, limit + 1
+        )
+    
+    async def _search_rows(
+        self,
+        conn,
+        query_embedding: np.ndarray,
+        top_k: int,
+        metadata_filter: Optional[Dict] = None,
+        collection: Optional[str] = DEFAULT_COLLECTION
+    ) -> List:
+        """Run the ANN query, choosing a strategy from filter selectivity"""
+        embedding = query_embedding.tolist()
+        # Everything the SQL text depends on besides the bound parameters
+        shape = (collection is not None, self.vector_storage, self.embedding_dim, self.rerank_factor)
+        
+        if not metadata_filter:
+            conditions, params = self._scope_conditions(collection, None, 2)
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            return await self.statements.run(
+                conn, 'fetch', 'search', shape,
+                lambda: self._ann_sql(where, f"${len(params) + 2}"),
+                embedding, *params, top_k
+            )
+        
+        # Hot filter with its own partial index: plain ANN over that index.
+        # The predicate is inlined so the planner can prove the index applies.
+        predicate = self.filtered_indexes.get((collection, self._filter_key(metadata_filter)))
+        if predicate is not None:
+            logger.debug(f"Filtered search via partial index: {predicate}")
+            conditions, params = self._scope_conditions(collection, None, 2)
+            results = await self.statements.run(
+                conn, 'fetch', 'search_partial_index', shape + (predicate,),
+                lambda: self._ann_sql(f"WHERE {' AND '.join(conditions + [predicate])}", f"${len(params) + 2}"),
+                embedding, *params, top_k
+            )
+            # The probed lists may hold fewer than top_k rows (few matches,
+            # or rows added since the index was built); use the paths below
+            if len(results) >= top_k:
+                return results
+        
+        matches = await self._count_filter_matches(
+            conn, metadata_filter, collection, self.exact_search_threshold
+        )
+        
+        if matches > self.exact_search_threshold:
+            # Broad filter: over-fetch ANN candidates and post-filter them,
+            # growing the candidate set and probes until top_k rows survive.
+            conditions, params = self._scope_conditions(collection, None, 3)
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            filter_param = len(params) + 3
+            
+            for round_idx in range(self.max_overfetch_rounds):
+                fetch_k = top_k * self.filter_overfetch * (4 ** round_idx)
+                if self.vector_storage != "full":
+                    fetch_k *= self.rerank_factor
+                probes = self.ivfflat_probes * (4 ** round_idx)
+                
+                async with conn.transaction():
+                    await self.statements.run(
+                        conn, 'execute', 'set_probes', (),
+                        lambda: "SELECT set_config('ivfflat.probes', $1, true)",
+                        str(probes)
+                    )
+                    results = await self.statements.run(
+                        conn, 'fetch', 'search_ann_postfilter', shape,
+                        lambda: f"""
+                        WITH candidates AS MATERIALIZED (
+                            SELECT id, content, metadata, embedding
+                            FROM documents
+                            {where}
+                            ORDER BY {self._ann_distance()}
+                            LIMIT $2
+                        )
+                        SELECT 
+                            id,
+                            content,
+                            metadata,
+                            embedding,
+                            1 - (embedding <=> $1::vector) as similarity
+                        FROM candidates
+                        WHERE metadata @> ${filter_param}::jsonb
+                        ORDER BY embedding <=> $1::vector
+                        LIMIT ${filter_param + 1}
+                        """,
+                        embedding, fetch_k, *params, json.dumps(metadata_filter), top_k
+                    )
+                
+                if len(results) >= top_k:
+                    logger.debug(f"Filtered search via ANN post-filter, round {round_idx + 1}")
+                    return results
+        
+        # Selective filter (or ANN rounds exhausted): exact distance over the
+        # pre-filtered rows, which the GIN index on metadata narrows down.
+        logger.debug(f"Filtered search via exact pre-filter ({matches} candidate rows)")
+        conditions, params = self._scope_conditions(collection, metadata_filter, 2)
+        return await self.statements.run(
+            conn, 'fetch', 'search_exact_prefilter', shape,
+            lambda: f"""
+            WITH candidates AS MATERIALIZED (
+                SELECT id, content, metadata, embedding
+                FROM documents
+                WHERE {' AND '.join(conditions)}
+            )
+            SELECT 
+                id,
+                content,
+                metadata,
+                embedding,
+                1 - (embedding <=> $1::vector) as similarity
+            FROM candidates
             ORDER BY embedding <=> $1::vector
-            LIMIT $%d
-        """ % (len(params) + 1)
+            LIMIT ${len(params) + 2}
+            """,
+            embedding, *params, top_k
+        )
+    
+    async def _search(
+        self,
+        query: str,
+        top_k: int,
+        metadata_filter: Optional[Dict],
+        collection: Optional[str]
+    ) -> Tuple[List, np.ndarray]:
+        """Embed the query and fetch the nearest rows"""
+        if self.storage is not None:
+            query_embedding = await self.generate_embedding(query)
+            results = await self.storage.search(query_embedding, top_k, metadata_filter, collection)
+            return results, query_embedding
         
-        params.append(top_k)
+        async def search(query_embedding):
+            async with self._read_conn() as conn:
+                return await self._search_rows(conn, query_embedding, top_k, metadata_filter, collection)
         
-        async with self.pool.acquire() as conn:
-            results = await conn.fetch(sql_query, *params)
+        query_embedding, results = await self._with_current_model(lambda: self.generate_embedding(query), search)
+        return results, query_embedding
+    
+    async def _log_search(self, query: str, query_embedding: np.ndarray, results_count: int, search_time: int):
+        """Record one caller's search in search_history"""
+        if self.storage is not None:
+            await self.storage.record_search(query, query_embedding, results_count, search_time)
+            return
         
-        # Log search metrics
-        search_time = int((time.time() - start_time) * 1000)
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                """
+        async with self._write_conn() as conn:
+            await self.statements.run(
+                conn, 'execute', 'history_insert', (),
+                lambda: """
                 INSERT INTO search_history (query, query_embedding, results_count, response_time_ms)
-                VALUES ($1, $2, $3, $4)
+                VALUES ($1, $2::vector, $3, $4)
                 """,
-                query, query_embedding.tolist(), len(results), search_time
+                query, query_embedding.tolist(), results_count, search_time
             )
-        
-        return [
-            {
+    
+    @staticmethod
+    def _format_results(results: List, include_embeddings: bool = False) -> List[Dict]:
+        """Convert search rows into result dicts"""
+        formatted = []
+        for r in results:
+            result = {
                 'id': r['id'],
                 'content': r['content'],
                 'metadata': json.loads(r['metadata']),
                 'similarity': float(r['similarity'])
             }
-            for r in results
-        ]
+            if include_embeddings:
+                result['embedding'] = r['embedding']
+            formatted.append(result)
+        
+        return formatted
+    
+    def _request_key(
+        self,
+        kind: str,
+        text: str,
+        top_k: int,
+        metadata_filter: Optional[Dict],
+        collection: Optional[str]
+    ) -> Tuple:
+        """Key under which identical requests are coalesced"""
+        normalized = " ".join(text.split()).casefold()
+        filter_key = self._filter_key(metadata_filter) if metadata_filter else None
+        return (kind, normalized, top_k, filter_key, collection)
+    
+    async def _single_flight(self, key: Tuple, factory, metric: str):
+        """Run `factory()` once for all concurrent callers with the same key.
+        
+        The first caller starts the work; duplicates arriving before it
+        finishes await the same task. The task is shielded so that a caller
+        giving up does not cancel the work for the others.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(
+                lambda done: self._inflight.pop(key) if self._inflight.get(key) is done else None
+            )
+        else:
+            self.metrics[metric] += 1
+        
+        result = await asyncio.shield(task)
+        # Every caller gets its own copy of the shared result
+        return copy.deepcopy(result)
+    
+    async def search(
+        self, 
+        query: str, 
+        top_k: int = 5,
+        metadata_filter: Optional[Dict] = None,
+        collection: Optional[str] = DEFAULT_COLLECTION
+    ) -> List[Dict]:
+        """Search for similar documents in a collection (None searches all)"""
+        start_time = time.time()
+        
+        async def run():
+            results, query_embedding = await self._search(query, top_k, metadata_filter, collection)
+            return self._format_results(results), query_embedding
+        
+        key = self._request_key('search', query, top_k, metadata_filter, collection)
+        results, query_embedding = await self._single_flight(key, run, 'coalesced_searches')
+        
+        # Coalesced callers each log their own search and latency
+        await self._log_search(query, query_embedding, len(results), int((time.time() - start_time) * 1000))
+        return results
+    
+    @staticmethod
+    def _merge_adjacent_chunks(context: List[Dict]) -> List[Dict]:
+        """Merge retrieved chunks that are neighbours in the same source document.
+        
+        `chunk_text` overlaps consecutive chunks, so the overlapping text is
+        kept once. Chunks without a known `source_doc_id` are left as they are.
+        """
+        merged = []
+        by_source = {}
+        
+        for doc in context:
+            metadata = doc.get('metadata', {})
+            source_id = metadata.get('source_doc_id')
+            if source_id in (None, 'unknown') or 'chunk_index' not in metadata:
+                merged.append(doc)
+            else:
+                by_source.setdefault(source_id, []).append(doc)
+        
+        for chunks in by_source.values():
+            chunks.sort(key=lambda d: d['metadata']['chunk_index'])
+            run = dict(chunks[0])
+            
+            for doc in chunks[1:]:
+                if doc['metadata']['chunk_index'] != run['metadata']['chunk_index'] + len(run.get('merged_ids', [run['id']])):
+                    merged.append(run)
+                    run = dict(doc)
+                    continue
+                
+                # Drop the text the two chunks share
+                head = doc['content'][:50]
+                overlap_at = run['content'].find(head, max(0, len(run['content']) - 400)) if head else -1
+                if overlap_at >= 0:
+                    run['content'] = run['content'][:overlap_at] + doc['content']
+                else:
+                    run['content'] = f"{run['content']} {doc['content']}"
+                
+                run['merged_ids'] = run.get('merged_ids', [run['id']]) + [doc['id']]
+                if doc['similarity'] > run['similarity']:
+                    run['similarity'] = doc['similarity']
+                    if 'embedding' in doc:
+                        run['embedding'] = doc['embedding']
+            
+            merged.append(run)
+        
+        return sorted(merged, key=lambda d: d['similarity'], reverse=True)
+    
+    @staticmethod
+    def _select_diverse(
+        context: List[Dict],
+        duplicate_threshold: float,
+        mmr_lambda: float
+    ) -> List[Dict]:
+        """Order chunks by maximal marginal relevance, dropping near-duplicates"""
+        if not context or any('embedding' not in doc for doc in context):
+            return context
+        
+        embeddings = np.stack([np.asarray(doc['embedding'], dtype=np.float32) for doc in context])
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        pairwise = embeddings @ embeddings.T
+        relevance = np.array([doc['similarity'] for doc in context])
+        
+        selected = []
+        remaining = list(range(len(context)))
+        
+        while remaining:
+            if selected:
+                redundancy = pairwise[np.ix_(remaining, selected)].max(axis=1)
+            else:
+                redundancy = np.zeros(len(remaining))
+            
+            # Near-duplicates of an already selected chunk are dropped outright
+            keep = redundancy < duplicate_threshold
+            remaining = [idx for idx, k in zip(remaining, keep) if k]
+            if not remaining:
+                break
+            redundancy = redundancy[keep]
+            
+            scores = mmr_lambda * relevance[remaining] - (1 - mmr_lambda) * redundancy
+            best = remaining.pop(int(np.argmax(scores)))
+            selected.append(best)
+        
+        return [context[idx] for idx in selected]
+    
+    def build_context(
+        self,
+        context: List[Dict],
+        token_budget: Optional[int] = None,
+        duplicate_threshold: float = 0.95,
+        mmr_lambda: float = 0.7
+    ) -> List[Dict]:
+        """Merge, de-duplicate and pack retrieved chunks into a token budget.
+        
+        Chunks are packed in relevance order, so whatever does not fit is the
+        least relevant rather than whatever the tokenizer truncates last.
+        """
+        token_budget = token_budget or self.context_token_budget
+        candidates = self._select_diverse(
+            self._merge_adjacent_chunks(context), duplicate_threshold, mmr_lambda
+        )
+        
+        packed = []
+        used_tokens = 0
+        
+        for doc in candidates:
+            token_ids = self.tokenizer(doc['content'], add_special_tokens=False)['input_ids']
+            # Allow for the "[Document i]: " header and separators
+            cost = len(token_ids) + 8
+            
+            if used_tokens + cost <= token_budget:
+                packed.append(doc)
+                used_tokens += cost
+            elif not packed:
+                # Always keep (part of) the most relevant chunk
+                doc = dict(doc)
+                doc['content'] = self.tokenizer.decode(token_ids[:max(token_budget - 8, 1)])
+                packed.append(doc)
+                used_tokens = token_budget
+        
+        return packed
+    
+    def _prefill(self, text: str) -> Tuple[torch.Tensor, object]:
+        """Run the LLM over a prompt prefix and keep its KV state"""
+        input_ids = self.tokenizer(text, return_tensors="pt").input_ids
+        with torch.no_grad():
+            outputs = self.llm_model(input_ids, use_cache=True)
+        return input_ids, outputs.past_key_values
+    
+    def _cached_prefix(self, first_doc: Optional[Dict]) -> Tuple[str, torch.Tensor, object]:
+        """Longest cached prompt prefix for a request, computing it if needed.
+        
+        Prefills run outside the lock so one request's prefill does not stall
+        the others; two requests may then prefill the same text, and the
+        first result stored is kept.
+        """
+        if self._prefix_kv is None:
+            prefix_kv = self._prefill(PROMPT_PREFIX)
+            with self._kv_lock:
+                if self._prefix_kv is None:
+                    self._prefix_kv = prefix_kv
+        prefix_text, (prefix_ids, past) = PROMPT_PREFIX, self._prefix_kv
+        
+        if first_doc is None or self.chunk_kv_cache_size <= 0:
+            return prefix_text, prefix_ids, past
+        
+        chunk_text = f"{PROMPT_PREFIX}[Document 1]: {first_doc['content']}"
+        key = hashlib.sha256(chunk_text.encode()).hexdigest()
+        
+        with self._kv_lock:
+            if key in self._chunk_kv_cache:
+                self._chunk_kv_cache.move_to_end(key)
+                self.metrics['chunk_kv_cache_hits'] += 1
+                chunk_ids, chunk_past = self._chunk_kv_cache[key]
+                return chunk_text, chunk_ids, chunk_past
+            
+            hits = self._chunk_kv_hits.pop(key, 0) + 1
+            if hits < self.chunk_kv_min_hits:
+                self._chunk_kv_hits[key] = hits
+                while len(self._chunk_kv_hits) > self.chunk_kv_candidates:
+                    self._chunk_kv_hits.popitem(last=False)
+                return prefix_text, prefix_ids, past
+        
+        chunk_kv = self._prefill(chunk_text)
+        with self._kv_lock:
+            chunk_kv = self._chunk_kv_cache.setdefault(key, chunk_kv)
+            self._chunk_kv_cache.move_to_end(key)
+            while len(self._chunk_kv_cache) > self.chunk_kv_cache_size:
+                self._chunk_kv_cache.popitem(last=False)
+        
+        chunk_ids, chunk_past = chunk_kv
+        return chunk_text, chunk_ids, chunk_past
     
     def generate_response(
         self, 
@@ -253,6 +2191,8 @@ class PostgresRAG:
         max_length: int = 200
     ) -> str:
         """Generate response using LLM with retrieved context"""
+        context = self.build_context(context)
+        
         # Combine context
         context_text = "\n\n".join([
             f"[Document {i+1}]: {doc['content']}"
@@ -260,21 +2200,32 @@ class PostgresRAG:
         ])
         
         # Create prompt
-        prompt = f"""Based on the following context, answer the question accurately and concisely.
-
-Context:
-{context_text}
+        prompt = f"""{PROMPT_PREFIX}{context_text}
 
 Question: {query}
 
 Answer:"""
         
-        # Generate response
-        inputs = self.tokenizer(prompt, return_tensors="pt", truncation=True, max_length=1024)
+        # Start from the cached KV state of the prompt prefix and only
+        # prefill the tokens that follow it
+        prefix_text, prefix_ids, past = self._cached_prefix(context[0] if context else None)
+        suffix_ids = self.tokenizer(
+            prompt[len(prefix_text):], return_tensors="pt", add_special_tokens=False
+        ).input_ids
+        input_ids = torch.cat([prefix_ids, suffix_ids], dim=1)[:, :1024]
+        
+        self.metrics['prefill_tokens_total'] += input_ids.shape[1]
+        self.metrics['prefill_tokens_saved'] += prefix_ids.shape[1]
+        
+        # Legacy tuple caches are never modified in place; cache objects are
+        if not isinstance(past, tuple):
+            past = copy.deepcopy(past)
         
         with torch.no_grad():
             outputs = self.llm_model.generate(
-                inputs.input_ids,
+                input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=past,
                 max_length=max_length,
                 num_return_sequences=1,
                 temperature=0.7,
@@ -295,25 +2246,62 @@ Answer:"""
         self, 
         question: str, 
         top_k: int = 5,
-        metadata_filter: Optional[Dict] = None
+        metadata_filter: Optional[Dict] = None,
+        collection: Optional[str] = DEFAULT_COLLECTION
     ) -> Dict:
         """Complete RAG pipeline: search + generate"""
-        # Search for relevant documents
-        search_results = await self.search(question, top_k, metadata_filter)
+        start_time = time.time()
         
-        # Generate response
-        response = self.generate_response(question, search_results)
+        async def run():
+            # Search for relevant documents
+            results, query_embedding = await self._search(question, top_k, metadata_filter, collection)
+            retrieval = (query_embedding, len(results), time.time())
+            
+            try:
+                async with self.limiters['generation'].slot():
+                    # Generate response (embeddings let the context builder drop near-duplicates)
+                    loop = asyncio.get_running_loop()
+                    response = await loop.run_in_executor(
+                        None,
+                        self.generate_response,
+                        question,
+                        self._format_results(results, include_embeddings=True)
+                    )
+            except StageOverloaded:
+                if not self.degrade_on_overload:
+                    raise
+                self.metrics['degraded_queries'] += 1
+                return {
+                    'question': question,
+                    'answer': None,
+                    'sources': self._format_results(results),
+                    'degraded': True,
+                    'timestamp': datetime.utcnow().isoformat()
+                }, retrieval
+            
+            return {
+                'question': question,
+                'answer': response,
+                'sources': self._format_results(results),
+                'timestamp': datetime.utcnow().isoformat()
+            }, retrieval
         
-        return {
-            'question': question,
-            'answer': response,
-            'sources': search_results,
-            'timestamp': datetime.utcnow().isoformat()
-        }
+        key = self._request_key('query', question, top_k, metadata_filter, collection)
+        result, (query_embedding, results_count, retrieved_at) = await self._single_flight(key, run, 'coalesced_queries')
+        result['question'] = question
+        
+        # Logged per caller: how long this caller waited for the retrieval
+        # (zero when it joined after the shared retrieval had finished)
+        search_time = int(max(retrieved_at - start_time, 0) * 1000)
+        await self._log_search(question, query_embedding, results_count, search_time)
+        return result
     
     async def get_stats(self) -> Dict:
         """Get system statistics"""
-        async with self.pool.acquire() as conn:
+        if self.storage is not None:
+            return await self.storage.stats()
+        
+        async with self._read_conn() as conn:
             stats = await conn.fetchrow("""
                 SELECT 
                     (SELECT COUNT(*) FROM documents) as total_documents,
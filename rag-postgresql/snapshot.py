@@ -0,0 +1,184 @@
+import argparse
+import asyncio
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+SNAPSHOT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+
+
+class SnapshotWriter:
+    """Writes a columnar snapshot of document chunks to a directory.
+
+    Layout:
+      embeddings.npy          float32 (count, dim), contiguous, memory-mappable
+      ids.npy                 int64 source row ids
+      collections.npy         uint16 index into manifest['collections']
+      content.bin / .offsets  UTF-8 text column and its int64 byte offsets
+      metadata.bin / .offsets JSON metadata column and its byte offsets
+      manifest.json           written last, marks the snapshot as complete
+    """
+
+    def __init__(self, path: str, count: int, dim: int):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.count = count
+        self.dim = dim
+        self.written = 0
+        self._collection_codes: Dict[str, int] = {}
+
+        self.embeddings = np.lib.format.open_memmap(
+            os.path.join(path, "embeddings.npy"), mode='w+', dtype=np.float32, shape=(count, dim)
+        )
+        self.ids = np.lib.format.open_memmap(
+            os.path.join(path, "ids.npy"), mode='w+', dtype=np.int64, shape=(count,)
+        )
+        self.collection_codes = np.lib.format.open_memmap(
+            os.path.join(path, "collections.npy"), mode='w+', dtype=np.uint16, shape=(count,)
+        )
+        self._text_files = {
+            column: open(os.path.join(path, f"{column}.bin"), "wb") for column in ('content', 'metadata')
+        }
+        self._offsets = {column: np.zeros(count + 1, dtype=np.int64) for column in self._text_files}
+
+    def append(self, rows: List) -> None:
+        """Append rows with id, collection, content, metadata and embedding"""
+        start, end = self.written, self.written + len(rows)
+        if end > self.count:
+            raise ValueError(f"Snapshot sized for {self.count} rows, got at least {end}")
+
+        self.embeddings[start:end] = np.stack([r['embedding'] for r in rows])
+        self.ids[start:end] = [r['id'] for r in rows]
+        self.collection_codes[start:end] = [
+            self._collection_codes.setdefault(r['collection'], len(self._collection_codes)) for r in rows
+        ]
+
+        for column, f in self._text_files.items():
+            offsets = self._offsets[column]
+            for i, r in enumerate(rows, start):
+                offsets[i + 1] = offsets[i] + f.write(r[column].encode('utf-8'))
+
+        self.written = end
+
+    def close(self, **manifest) -> Dict:
+        """Flush all columns and write the manifest"""
+        if self.written != self.count:
+            raise ValueError(f"Snapshot sized for {self.count} rows, got {self.written}")
+
+        for column, f in self._text_files.items():
+            f.close()
+            np.save(os.path.join(self.path, f"{column}.offsets.npy"), self._offsets[column])
+        for array in (self.embeddings, self.ids, self.collection_codes):
+            array.flush()
+
+        manifest = {
+            'version': SNAPSHOT_VERSION,
+            'created_at': datetime.utcnow().isoformat(),
+            'count': self.count,
+            'dim': self.dim,
+            'collections': sorted(self._collection_codes, key=self._collection_codes.get),
+            **manifest
+        }
+        with open(os.path.join(self.path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+
+        return manifest
+
+
+class Snapshot:
+    """Read-only, memory-mapped view of a snapshot directory.
+
+    `embeddings` is a float32 (count, dim) memmap and can be used directly
+    for offline analysis; nothing is read until it is accessed.
+    """
+
+    def __init__(self, path: str):
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            raise FileNotFoundError(f"No complete snapshot in {path} (missing {MANIFEST_FILE})")
+
+        with open(manifest_path, encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        if self.manifest['version'] != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {self.manifest['version']}")
+
+        self.path = path
+        self.collections: List[str] = self.manifest['collections']
+        self.embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode='r')
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode='r')
+        self.collection_codes = np.load(os.path.join(path, "collections.npy"), mmap_mode='r')
+        self._text = {}
+        self._offsets = {}
+        for column in ('content', 'metadata'):
+            self._offsets[column] = np.load(os.path.join(path, f"{column}.offsets.npy"), mmap_mode='r')
+            blob = os.path.join(path, f"{column}.bin")
+            # np.memmap cannot map an empty file
+            self._text[column] = (
+                np.memmap(blob, dtype=np.uint8, mode='r') if os.path.getsize(blob) else np.zeros(0, np.uint8)
+            )
+
+    def __len__(self) -> int:
+        return self.manifest['count']
+
+    def text(self, column: str, start: int, end: int) -> List[str]:
+        """Decode rows [start, end) of the content or metadata column"""
+        offsets = self._offsets[column][start:end + 1]
+        data = self._text[column][offsets[0]:offsets[-1]].tobytes()
+        base = offsets[0]
+        return [data[a - base:b - base].decode('utf-8') for a, b in zip(offsets[:-1], offsets[1:])]
+
+    def batches(self, batch_size: int = 5000) -> Iterator[Dict]:
+        """Yield the rows in column batches"""
+        for start in range(0, len(self), batch_size):
+            end = min(start + batch_size, len(self))
+            yield {
+                'collection': [self.collections[c] for c in self.collection_codes[start:end]],
+                'content': self.text('content', start, end),
+                'metadata': self.text('metadata', start, end),
+                'embedding': self.embeddings[start:end]
+            }
+
+
+async def main():
+    """Export or import a documents snapshot without loading any model"""
+    from postgres_rag import PostgresRAG
+
+    parser = argparse.ArgumentParser(description="Export/import documents and embeddings snapshots")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="Snapshot directory")
+    parser.add_argument("--collection", help="Export only this collection / import everything into it")
+    parser.add_argument("--no-reindex", action="store_true", help="Do not rebuild ANN indexes after import")
+    args = parser.parse_args()
+
+    db_config = {
+        'host': os.getenv('DB_HOST', 'localhost'),
+        'port': int(os.getenv('DB_PORT', 5432)),
+        'user': os.getenv('DB_USER', 'raguser'),
+        'password': os.getenv('DB_PASSWORD', 'ragpass'),
+        'database': os.getenv('DB_NAME', 'ragdb')
+    }
+
+    rag = PostgresRAG(
+        db_config,
+        embedding_model_name=os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2'),
+        load_models=False
+    )
+    await rag.connect()
+    try:
+        if args.command == "export":
+            manifest = await rag.export_snapshot(args.path, collection=args.collection)
+            print(f"Exported {manifest['count']} chunks to {args.path}")
+        else:
+            imported = await rag.import_snapshot(
+                args.path, collection=args.collection, rebuild_indexes=not args.no_reindex
+            )
+            print(f"Imported {imported} chunks from {args.path}")
+    finally:
+        await rag.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
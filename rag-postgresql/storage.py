@@ -0,0 +1,386 @@
+import json
+import os
+import shutil
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from snapshot import Snapshot, SnapshotWriter
+
+
+class VectorStore(ABC):
+    """Storage backend for document chunks, their embeddings and the embedding cache.
+
+    `PostgresRAG` talks to PostgreSQL itself when no store is given; a store
+    replaces the database for ingestion, search, the cache and stats.
+    Search rows have the same fields as the SQL rows: id, content, metadata
+    (JSON text), embedding and similarity.
+    """
+
+    # Model and dimension of the embeddings the store expects, when known
+    embedding_model: Optional[str] = None
+    dim: Optional[int] = None
+
+    async def connect(self):
+        """Open the store"""
+
+    async def close(self):
+        """Flush and close the store"""
+
+    @abstractmethod
+    async def add_chunks(self, collection: str, chunks: List[Tuple[str, np.ndarray, Dict]]) -> int:
+        """Store (content, embedding, metadata) chunks in a collection"""
+
+    @abstractmethod
+    async def search(
+        self,
+        query_embedding: np.ndarray,
+        top_k: int,
+        metadata_filter: Optional[Dict] = None,
+        collection: Optional[str] = None
+    ) -> List[Dict]:
+        """Return the `top_k` chunks closest to the query by cosine similarity"""
+
+    @abstractmethod
+    async def delete(self, metadata_filter: Dict, collection: Optional[str] = None) -> int:
+        """Delete the chunks whose metadata contains `metadata_filter`"""
+
+    @abstractmethod
+    async def get_cached_embedding(self, text_hash: str) -> Optional[np.ndarray]:
+        """Look up a cached embedding"""
+
+    @abstractmethod
+    async def cache_embedding(self, text_hash: str, text: str, embedding: np.ndarray):
+        """Cache an embedding"""
+
+    async def record_search(self, query: str, query_embedding: np.ndarray, results_count: int, response_time_ms: int):
+        """Record a search for analytics"""
+
+    @abstractmethod
+    async def stats(self) -> Dict:
+        """Same keys as PostgresRAG.get_stats"""
+
+
+def _json_contains(document, pattern) -> bool:
+    """jsonb `@>` containment for decoded JSON values"""
+    if isinstance(pattern, dict):
+        return isinstance(document, dict) and all(
+            key in document and _json_contains(document[key], value) for key, value in pattern.items()
+        )
+    if isinstance(pattern, list):
+        return isinstance(document, list) and all(
+            any(_json_contains(item, wanted) for item in document) for wanted in pattern
+        )
+    if isinstance(document, bool) or isinstance(pattern, bool):
+        return document is pattern
+    if isinstance(document, (int, float)) and isinstance(pattern, (int, float)):
+        return document == pattern
+    return type(document) is type(pattern) and document == pattern
+
+
+def _posting_key(key: str, value) -> Optional[Tuple]:
+    """Inverted index key for a top-level scalar metadata value (None if not indexable)"""
+    if isinstance(value, bool):
+        return (key, 'bool', value)
+    if isinstance(value, (int, float)):
+        # jsonb compares numbers by value: 1 and 1.0 are equal
+        return (key, 'num', float(value))
+    if isinstance(value, str):
+        return (key, 'str', value)
+    if value is None:
+        return (key, 'null')
+    return None
+
+
+class NumpyVectorStore(VectorStore):
+    """In-process exact search over a contiguous float32 matrix.
+
+    Top-k is a single matrix-vector product plus `argpartition`. Collections
+    and top-level scalar metadata values have inverted indexes, so filtered
+    searches only score the matching rows; other filters fall back to a
+    containment check over the collection. Deleted rows are masked out.
+
+    With `path`, the store loads from and saves to a snapshot directory (see
+    snapshot.py) whose embeddings are memory-mapped until the first write.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        embedding_model: Optional[str] = None,
+        cache_size: int = 10000,
+        dim: Optional[int] = None
+    ):
+        self.path = path
+        self.embedding_model = embedding_model
+        self.dim = dim
+        self.cache_size = cache_size
+        self._reset()
+
+    def _reset(self):
+        """Empty the store"""
+        self._size = 0
+        self._embeddings: Optional[np.ndarray] = None
+        self._norms = np.zeros(0, dtype=np.float32)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._alive = np.zeros(0, dtype=bool)
+        self._contents: List[str] = []
+        self._metadata: List[str] = []
+        self._collections: List[str] = []
+        self._next_id = 1
+
+        self._collection_rows: Dict[str, List[int]] = defaultdict(list)
+        self._postings: Dict[Tuple, List[int]] = defaultdict(list)
+        self._posting_arrays: Dict[Tuple, np.ndarray] = {}
+
+        self._cache: OrderedDict = OrderedDict()
+        self._searches = 0
+        self._search_time_ms = 0
+
+    async def connect(self):
+        """Load the snapshot at `path`, if there is one"""
+        if self.path and os.path.exists(self.path):
+            self.load(self.path)
+
+    async def close(self):
+        """Save to `path`, if set"""
+        if self.path:
+            self.save(self.path)
+
+    def __len__(self) -> int:
+        return int(self._alive[:self._size].sum())
+
+    def _reserve(self, rows: int, dim: int):
+        """Grow the row arrays (doubling) so `rows` more rows fit"""
+        needed = self._size + rows
+        if self._embeddings is not None:
+            if self._embeddings.shape[1] != dim:
+                raise ValueError(f"Embedding dimension {dim} does not match the store's {self._embeddings.shape[1]}")
+            # A memory-mapped snapshot is read-only, copy it on the first write
+            if needed <= len(self._embeddings) and not isinstance(self._embeddings, np.memmap):
+                return
+
+        capacity = max(needed, 2 * len(self._norms), 1024)
+        embeddings = np.zeros((capacity, dim), dtype=np.float32)
+        if self._embeddings is not None:
+            embeddings[:self._size] = self._embeddings[:self._size]
+        self._embeddings = embeddings
+        for name in ('_norms', '_ids', '_alive'):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def _append(self, ids: np.ndarray, collections: List[str], contents: List[str], metadata: List[str], embeddings: np.ndarray):
+        """Append rows and index them"""
+        start, end = self._size, self._size + len(contents)
+        self._reserve(len(contents), embeddings.shape[1])
+
+        self._embeddings[start:end] = embeddings
+        self._norms[start:end] = np.linalg.norm(embeddings, axis=1)
+        self._ids[start:end] = ids
+        self._alive[start:end] = True
+        self._contents.extend(contents)
+        self._metadata.extend(metadata)
+        self._collections.extend(collections)
+        self._index_rows(start, collections, metadata)
+        self._size = end
+        self._next_id = max(self._next_id, int(ids.max()) + 1)
+
+    def _index_rows(self, start: int, collections: List[str], metadata: List[str]):
+        """Add rows to the collection and metadata inverted indexes"""
+        for row, (collection, metadata_json) in enumerate(zip(collections, metadata), start):
+            self._collection_rows[collection].append(row)
+            for key, value in json.loads(metadata_json).items():
+                posting = _posting_key(key, value)
+                if posting is not None:
+                    self._postings[(collection,) + posting].append(row)
+
+        self._posting_arrays.clear()
+
+    async def add_chunks(self, collection: str, chunks: List[Tuple[str, np.ndarray, Dict]]) -> int:
+        if not chunks:
+            return 0
+
+        ids = np.arange(self._next_id, self._next_id + len(chunks), dtype=np.int64)
+        self._append(
+            ids,
+            [collection] * len(chunks),
+            [content for content, _, _ in chunks],
+            [json.dumps(metadata) for _, _, metadata in chunks],
+            np.stack([np.asarray(embedding, dtype=np.float32) for _, embedding, _ in chunks])
+        )
+        return len(chunks)
+
+    def _rows(self, key: Tuple, rows: List[int]) -> np.ndarray:
+        """Sorted row numbers of an inverted index entry, as an array"""
+        array = self._posting_arrays.get(key)
+        if array is None:
+            array = self._posting_arrays[key] = np.asarray(rows, dtype=np.int64)
+        return array
+
+    def _candidates(self, metadata_filter: Optional[Dict], collection: Optional[str]) -> Optional[np.ndarray]:
+        """Live rows matching a collection and filter (None means every live row)"""
+        collections = [collection] if collection is not None else list(self._collection_rows)
+        if collection is None and not metadata_filter:
+            return None
+
+        matches = []
+        for name in collections:
+            if name not in self._collection_rows:
+                continue
+            rows = self._rows((name,), self._collection_rows[name])
+
+            unindexed = {}
+            for key, value in (metadata_filter or {}).items():
+                posting = _posting_key(key, value)
+                if posting is None:
+                    unindexed[key] = value
+                    continue
+                posting = (name,) + posting
+                rows = np.intersect1d(rows, self._rows(posting, self._postings.get(posting, [])), assume_unique=True)
+
+            if unindexed:
+                rows = np.array(
+                    [row for row in rows if _json_contains(json.loads(self._metadata[row]), unindexed)],
+                    dtype=np.int64
+                )
+            matches.append(rows)
+
+        if not matches:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.concatenate(matches)
+        return rows[self._alive[rows]]
+
+    async def search(
+        self,
+        query_embedding: np.ndarray,
+        top_k: int,
+        metadata_filter: Optional[Dict] = None,
+        collection: Optional[str] = None
+    ) -> List[Dict]:
+        if self._size == 0:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        rows = self._candidates(metadata_filter, collection)
+
+        if rows is None:
+            similarities = self._embeddings[:self._size] @ query
+            similarities /= np.maximum(self._norms[:self._size] * np.linalg.norm(query), 1e-12)
+            similarities[~self._alive[:self._size]] = -np.inf
+            rows = np.arange(self._size)
+        else:
+            similarities = self._embeddings[rows] @ query
+            similarities /= np.maximum(self._norms[rows] * np.linalg.norm(query), 1e-12)
+
+        k = min(top_k, len(rows))
+        if k == 0:
+            return []
+        best = np.argpartition(-similarities, k - 1)[:k]
+        best = best[np.argsort(-similarities[best])]
+
+        return [
+            {
+                'id': int(self._ids[rows[i]]),
+                'content': self._contents[rows[i]],
+                'metadata': self._metadata[rows[i]],
+                'embedding': self._embeddings[rows[i]].copy(),
+                'similarity': float(similarities[i])
+            }
+            for i in best
+            if similarities[i] > -np.inf
+        ]
+
+    async def delete(self, metadata_filter: Dict, collection: Optional[str] = None) -> int:
+        rows = self._candidates(metadata_filter, collection)
+        if rows is None:
+            rows = np.flatnonzero(self._alive[:self._size])
+        self._alive[rows] = False
+        return len(rows)
+
+    async def get_cached_embedding(self, text_hash: str) -> Optional[np.ndarray]:
+        embedding = self._cache.get(text_hash)
+        if embedding is not None:
+            self._cache.move_to_end(text_hash)
+        return embedding
+
+    async def cache_embedding(self, text_hash: str, text: str, embedding: np.ndarray):
+        self._cache[text_hash] = np.asarray(embedding, dtype=np.float32)
+        self._cache.move_to_end(text_hash)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def record_search(self, query: str, query_embedding: np.ndarray, results_count: int, response_time_ms: int):
+        self._searches += 1
+        self._search_time_ms += response_time_ms
+
+    async def stats(self) -> Dict:
+        return {
+            'total_documents': len(self),
+            'total_searches': self._searches,
+            'avg_response_time_ms': self._search_time_ms / self._searches if self._searches else None,
+            'cached_embeddings': len(self._cache)
+        }
+
+    def load(self, path: str):
+        """Replace the contents with a snapshot, memory-mapping its embeddings"""
+        snapshot = Snapshot(path)
+        manifest = snapshot.manifest
+        rows = len(snapshot)
+
+        if self.embedding_model and manifest.get('embedding_model') not in (None, self.embedding_model):
+            raise ValueError(
+                f"Snapshot embeddings come from {manifest['embedding_model']}, not {self.embedding_model}"
+            )
+        if self.dim and rows and manifest['dim'] != self.dim:
+            raise ValueError(f"Snapshot dimension {manifest['dim']} does not match {self.dim}")
+
+        self._reset()
+        self.embedding_model = self.embedding_model or manifest.get('embedding_model')
+        if rows == 0:
+            return
+        self.dim = self.dim or manifest['dim']
+
+        # Read-only mapping; _reserve copies it into memory on the first write
+        self._embeddings = snapshot.embeddings
+        self._norms = np.linalg.norm(snapshot.embeddings, axis=1).astype(np.float32)
+        self._ids = np.array(snapshot.ids)
+        self._alive = np.ones(rows, dtype=bool)
+        self._contents = snapshot.text('content', 0, rows)
+        self._metadata = snapshot.text('metadata', 0, rows)
+        self._collections = [snapshot.collections[c] for c in snapshot.collection_codes]
+        self._index_rows(0, self._collections, self._metadata)
+        self._size = rows
+        self._next_id = int(self._ids.max()) + 1
+
+    def save(self, path: str):
+        """Write the live rows as a snapshot, replacing any previous one"""
+        live = np.flatnonzero(self._alive[:self._size])
+        dim = self._embeddings.shape[1] if self._embeddings is not None else 0
+
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        writer = SnapshotWriter(tmp_path, len(live), dim)
+        for start in range(0, len(live), 5000):
+            writer.append([
+                {
+                    'id': self._ids[row],
+                    'collection': self._collections[row],
+                    'content': self._contents[row],
+                    'metadata': self._metadata[row],
+                    'embedding': self._embeddings[row]
+                }
+                for row in live[start:start + 5000]
+            ])
+        writer.close(embedding_model=self.embedding_model)
+
+        # Swap directories; a mapped old snapshot stays readable until unmapped
+        old_path = f"{path}.old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
@@ -1,7 +1,8 @@
 import pytest
 import asyncio
 import asyncpg
-from postgres_rag import PostgresRAG
+from postgres_rag import PostgresRAG, PROMPT_PREFIX, StageLimiter, StageOverloaded
+from storage import NumpyVectorStore
 import numpy as np
 import time
 
@@ -147,6 +148,361 @@ async def test_metadata_filter(rag_system, clean_database):
     assert len(results) == 1
     assert results[0]['metadata']['level'] == 'beginner'
 
+@pytest.mark.asyncio
+async def test_filtered_search_fills_top_k(rag_system, clean_database):
+    """Test that selective and broad filters both return full top_k results"""
+    documents = [
+        {
+            'content': f'Vector search note number {i} about PostgreSQL indexes.',
+            'metadata': {'category': 'rare' if i < 3 else 'common'}
+        }
+        for i in range(30)
+    ]
+    
+    await rag_system.add_documents(documents)
+    
+    # Selective filter: exact pre-filtered search
+    results = await rag_system.search("PostgreSQL indexes", top_k=3, metadata_filter={'category': 'rare'})
+    assert len(results) == 3
+    assert all(r['metadata']['category'] == 'rare' for r in results)
+    
+    # Broad filter: force the ANN over-fetch + post-filter path
+    rag_system.exact_search_threshold = 0
+    try:
+        results = await rag_system.search("PostgreSQL indexes", top_k=5, metadata_filter={'category': 'common'})
+    finally:
+        rag_system.exact_search_threshold = 2000
+    
+    assert len(results) == 5
+    assert all(r['metadata']['category'] == 'common' for r in results)
+    similarities = [r['similarity'] for r in results]
+    assert similarities == sorted(similarities, reverse=True)
+
+@pytest.mark.asyncio
+async def test_collections_are_isolated(rag_system, clean_database):
+    """Test that searches are scoped to one collection partition"""
+    await rag_system.add_documents(
+        [{'content': 'PostgreSQL partitions split large tables.', 'metadata': {}}],
+        collection='test_manuals'
+    )
+    await rag_system.add_documents(
+        [{'content': 'PostgreSQL replication keeps standbys in sync.', 'metadata': {}}]
+    )
+    
+    results = await rag_system.search("PostgreSQL", top_k=5, collection='test_manuals')
+    assert len(results) == 1
+    assert 'partitions' in results[0]['content']
+    
+    results = await rag_system.search("PostgreSQL", top_k=5, collection=None)
+    assert len(results) == 2
+    
+    lists = await rag_system.rebuild_collection_index('test_manuals')
+    assert lists >= 1
+    
+    with pytest.raises(ValueError):
+        await rag_system.create_collection('Not A Valid Name')
+
+@pytest.mark.asyncio
+async def test_compact_vector_storage(rag_system, clean_database):
+    """Test that compact indexes are re-ranked by exact distance"""
+    await rag_system.add_documents([
+        {'content': 'PostgreSQL stores vectors with pgvector.', 'metadata': {}},
+        {'content': 'Bread is baked in a hot oven.', 'metadata': {}}
+    ])
+    
+    expected = await rag_system.search("pgvector vectors", top_k=2)
+    
+    try:
+        for mode in ('halfvec', 'binary'):
+            rag_system.vector_storage = mode
+            await rag_system.rebuild_collection_index('default', lists=1)
+            results = await rag_system.search("pgvector vectors", top_k=2)
+            
+            assert [r['id'] for r in results] == [r['id'] for r in expected]
+            # Similarities come from the full precision vectors
+            assert results[0]['similarity'] == pytest.approx(expected[0]['similarity'], abs=1e-6)
+    finally:
+        rag_system.vector_storage = 'full'
+        await rag_system.rebuild_collection_index('default', lists=100)
+
+@pytest.mark.asyncio
+async def test_statement_registry_reuse(rag_system, clean_database):
+    """Test that repeated searches reuse one statement per shape"""
+    await rag_system.add_documents([{'content': 'Prepared statements skip parsing.', 'metadata': {'kind': 'note'}}])
+    
+    await rag_system.search("statements", top_k=1)
+    await rag_system.search("statements", top_k=1, metadata_filter={'kind': 'note'})
+    shapes = len(rag_system.statements._sql)
+    
+    for query in ("parsing", "planning", "binding"):
+        await rag_system.search(query, top_k=1)
+        await rag_system.search(query, top_k=1, metadata_filter={'kind': 'note'})
+    
+    assert len(rag_system.statements._sql) == shapes
+    stats = rag_system.statements.stats()
+    assert stats['search']['calls'] >= 4
+    assert stats['search_exact_prefilter']['calls'] >= 4
+    assert stats['history_insert']['calls'] >= 8
+
+@pytest.mark.asyncio
+async def test_replace_documents_is_atomic(rag_system, clean_database, monkeypatch):
+    """Test that replacing a source's chunks happens in one transaction"""
+    old = {'content': 'Old version of the chapter.', 'metadata': {'source_file': 'a.pdf'}}
+    new = {'content': 'New version of the chapter.', 'metadata': {'source_file': 'a.pdf'}}
+    await rag_system.add_documents([old])
+    
+    # The insert fails after the delete, which must be rolled back
+    async def failing_insert(conn, chunks_data, collection):
+        raise RuntimeError("insert failed")
+    
+    with monkeypatch.context() as patch:
+        patch.setattr(rag_system, '_insert_chunks', failing_insert)
+        with pytest.raises(RuntimeError):
+            await rag_system.replace_documents({'source_file': 'a.pdf'}, [new])
+    results = await rag_system.search("chapter version", top_k=5, metadata_filter={'source_file': 'a.pdf'})
+    assert [r['content'] for r in results] == [old['content']]
+    
+    assert await rag_system.replace_documents({'source_file': 'a.pdf'}, [new]) == (1, 1)
+    results = await rag_system.search("chapter version", top_k=5, metadata_filter={'source_file': 'a.pdf'})
+    assert [r['content'] for r in results] == [new['content']]
+
+@pytest.mark.asyncio
+async def test_identical_searches_are_coalesced(rag_system, clean_database):
+    """Test that concurrent identical searches share one execution"""
+    await rag_system.add_documents([{'content': 'Coalescing merges duplicate work.', 'metadata': {}}])
+    coalesced_before = rag_system.metrics['coalesced_searches']
+    history_before = rag_system.statements.stats()['history_insert']['calls']
+    
+    results = await asyncio.gather(*[
+        rag_system.search("  Duplicate   WORK ", top_k=1) if i % 2 else rag_system.search("duplicate work", top_k=1)
+        for i in range(10)
+    ])
+    
+    assert all(r == results[0] for r in results)
+    assert rag_system.metrics['coalesced_searches'] - coalesced_before == 9
+    # ...but every caller is logged, with its own query text
+    assert rag_system.statements.stats()['history_insert']['calls'] - history_before == 10
+    async with rag_system._write_conn() as conn:
+        logged = await conn.fetch("SELECT query FROM search_history")
+    assert sorted(r['query'] for r in logged) == sorted(["  Duplicate   WORK "] * 5 + ["duplicate work"] * 5)
+
+@pytest.mark.asyncio
+async def test_stage_limiter_sheds_load():
+    """Test bounded queueing and fast rejection in a stage limiter"""
+    limiter = StageLimiter('generation', max_concurrency=1, max_queue=1, queue_timeout=0.1)
+    release = asyncio.Event()
+    
+    async def hold():
+        async with limiter.slot():
+            await release.wait()
+    
+    holder = asyncio.ensure_future(hold())
+    await asyncio.sleep(0)
+    waiter = asyncio.ensure_future(hold())
+    await asyncio.sleep(0)
+    
+    # Queue is full: rejected immediately
+    with pytest.raises(StageOverloaded) as excinfo:
+        async with limiter.slot():
+            pass
+    assert excinfo.value.reason == 'queue_full'
+    assert excinfo.value.retry_after >= 1
+    
+    # The queued request gives up once its deadline passes
+    with pytest.raises(StageOverloaded) as excinfo:
+        await waiter
+    assert excinfo.value.reason == 'deadline'
+    
+    release.set()
+    await holder
+    assert limiter.active == 0 and limiter.waiting == 0
+    assert limiter.rejected == {'queue_full': 1, 'deadline': 1}
+
+@pytest.mark.asyncio
+async def test_degraded_query_on_overload(rag_system, clean_database):
+    """Test retrieval-only answers when generation is overloaded"""
+    await rag_system.add_documents([{'content': 'Load shedding protects latency.', 'metadata': {}}])
+    limiter = rag_system.limiters['generation']
+    original = (limiter.max_queue, rag_system.degrade_on_overload)
+    
+    # No queue at all and every slot taken
+    limiter.max_queue = 0
+    rag_system.degrade_on_overload = True
+    async with limiter.slot(bounded=False):
+        async with limiter.slot(bounded=False):
+            result = await rag_system.query("What protects latency?", top_k=1)
+    
+    limiter.max_queue, rag_system.degrade_on_overload = original
+    
+    assert result['degraded'] is True
+    assert result['answer'] is None
+    assert len(result['sources']) == 1
+
+@pytest.mark.asyncio
+async def test_read_replica_routing(rag_system):
+    """Test that reads are spread over the replica pools"""
+    config = {
+        **TEST_DB_CONFIG,
+        'replicas': [TEST_DB_CONFIG, TEST_DB_CONFIG],
+        'read_pool_min_size': 1,
+        'read_pool_max_size': 2
+    }
+    original_config = rag_system.db_config
+    await rag_system.close()
+    rag_system.db_config = config
+    
+    try:
+        await rag_system.connect()
+        assert len(rag_system.read_pools) == 2
+        assert rag_system.pool not in rag_system.read_pools
+        
+        picked = {id(rag_system._read_pool()) for _ in range(4)}
+        assert picked == {id(pool) for pool in rag_system.read_pools}
+        
+        stats = await rag_system.get_stats()
+        assert 'total_documents' in stats
+    finally:
+        await rag_system.close()
+        rag_system.db_config = original_config
+        await rag_system.connect()
+
+@pytest.mark.asyncio
+async def test_snapshot_round_trip(rag_system, clean_database, tmp_path):
+    """Test that a snapshot restores documents and embeddings without re-embedding"""
+    await rag_system.add_documents([
+        {'content': 'Snapshots copy embeddings between databases.', 'metadata': {'source': 'ops'}},
+        {'content': 'Vector search runs over the restored rows.', 'metadata': {'source': 'ops'}}
+    ])
+    before = await rag_system.search("restored embeddings", top_k=2)
+    
+    manifest = await rag_system.export_snapshot(str(tmp_path))
+    assert manifest['count'] == 2
+    assert np.load(tmp_path / "embeddings.npy", mmap_mode='r').shape == (2, 384)
+    
+    await rag_system.delete_documents({'source': 'ops'})
+    encode = rag_system.embedding_model.encode
+    rag_system.embedding_model.encode = None  # any inference would fail
+    try:
+        assert await rag_system.import_snapshot(str(tmp_path)) == 2
+    finally:
+        rag_system.embedding_model.encode = encode
+    
+    after = await rag_system.search("restored embeddings", top_k=2)
+    assert [r['content'] for r in after] == [r['content'] for r in before]
+    assert after[0]['similarity'] == pytest.approx(before[0]['similarity'], abs=1e-6)
+
+@pytest.mark.asyncio
+async def test_numpy_store_search_filter_and_persistence(tmp_path):
+    """Test exact top-k, inverted-index filtering and memory-mapped reload"""
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(500, 384)).astype(np.float32)
+    store = NumpyVectorStore(str(tmp_path / "store"))
+    await store.add_chunks('default', [
+        (f"chunk {i}", embeddings[i], {'source': 'a' if i % 2 else 'b', 'page': i % 10})
+        for i in range(500)
+    ])
+    
+    results = await store.search(embeddings[7], top_k=3)
+    similarities = embeddings @ embeddings[7] / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(embeddings[7]))
+    assert [r['content'] for r in results] == [f"chunk {i}" for i in np.argsort(-similarities)[:3]]
+    
+    filtered = await store.search(embeddings[7], top_k=5, metadata_filter={'source': 'b', 'page': 4})
+    assert len(filtered) == 5
+    assert all(int(r['content'].split()[1]) % 10 == 4 for r in filtered)
+    assert await store.search(embeddings[7], top_k=3, collection='other') == []
+    
+    assert await store.delete({'source': 'a'}) == 250
+    await store.close()
+    
+    reloaded = NumpyVectorStore(str(tmp_path / "store"))
+    await reloaded.connect()
+    assert len(reloaded) == 250
+    assert [r['id'] for r in await reloaded.search(embeddings[8], top_k=2)] == \
+        [r['id'] for r in await store.search(embeddings[8], top_k=2)]
+
+@pytest.mark.asyncio
+async def test_numpy_store_rejects_other_model_snapshot(tmp_path):
+    """Test that loading a snapshot of another model or dimension fails"""
+    store = NumpyVectorStore(str(tmp_path / "store"), embedding_model='all-MiniLM-L6-v2')
+    await store.add_chunks('default', [("chunk", np.ones(384, dtype=np.float32), {})])
+    await store.close()
+    
+    with pytest.raises(ValueError):
+        await NumpyVectorStore(str(tmp_path / "store"), embedding_model='all-mpnet-base-v2').connect()
+    with pytest.raises(ValueError):
+        await NumpyVectorStore(str(tmp_path / "store"), embedding_model='all-MiniLM-L6-v2', dim=768).connect()
+    
+    reloaded = NumpyVectorStore(str(tmp_path / "store"), embedding_model='all-MiniLM-L6-v2', dim=384)
+    await reloaded.connect()
+    assert len(reloaded) == 1
+
+@pytest.mark.asyncio
+async def test_rag_without_database():
+    """Test ingestion, search and stats on the in-process storage backend"""
+    rag = PostgresRAG(None, storage=NumpyVectorStore())
+    await rag.connect()
+    
+    await rag.add_documents([
+        {'content': 'pgvector adds vector search to PostgreSQL.', 'metadata': {'source': 'docs'}},
+        {'content': 'Bananas are a good source of potassium.', 'metadata': {'source': 'food'}}
+    ])
+    results = await rag.search("vector database search", top_k=1)
+    assert results[0]['metadata']['source'] == 'docs'
+    
+    stats = await rag.get_stats()
+    assert stats['total_documents'] == 2
+    assert stats['total_searches'] == 1
+    
+    # PostgreSQL-only operations fail cleanly instead of hitting a missing pool
+    with pytest.raises(ValueError):
+        await rag.create_collection('other')
+    with pytest.raises(ValueError):
+        await rag.create_filtered_index({'source': 'docs'})
+    await rag.close()
+
+@pytest.mark.asyncio
+async def test_warm_up_loads_hot_queries(rag_system, clean_database):
+    """Test that warm-up fills the in-process embedding LRU from search_history"""
+    await rag_system.add_documents([{'content': 'Warm caches keep tail latency low.', 'metadata': {}}])
+    for _ in range(3):
+        await rag_system.search("why warm caches")
+    await rag_system.search("cold query")
+    
+    rag_system._embedding_lru.clear()
+    stats = await rag_system.warm_up(top_n=1, sample_searches=1)
+    
+    assert rag_system.ready
+    assert stats['completed']
+    assert stats['embeddings_loaded'] == 1
+    assert stats['searches'] == len(rag_system.read_pools)
+    assert list(rag_system._embedding_lru) == [rag_system._text_hash("why warm caches")]
+
+@pytest.mark.asyncio
+async def test_reembed_switches_column_online(rag_system, clean_database):
+    """Test that re-embedding fills the shadow column and swaps it in"""
+    await rag_system.add_documents([
+        {'content': 'Shadow columns let the model change without downtime.', 'metadata': {}},
+        {'content': 'Keyset cursors walk the table in primary key order.', 'metadata': {}}
+    ])
+    
+    progress = await rag_system.reembed('all-MiniLM-L6-v2', batch_size=1)
+    
+    assert progress['state'] == 'completed'
+    assert progress['rows_done'] == progress['rows_total'] == 2
+    assert progress['rows_per_second'] > 0
+    assert await rag_system.reembed_status() == progress
+    
+    async with rag_system._write_conn() as conn:
+        columns = await conn.fetch(
+            "SELECT attname FROM pg_attribute WHERE attrelid = 'documents'::regclass AND attname LIKE 'embedding%' AND NOT attisdropped"
+        )
+        generation = await conn.fetchval("SELECT generation FROM embedding_model")
+    assert [c['attname'] for c in columns] == ['embedding']
+    assert rag_system._model_generation == generation
+    
+    results = await rag_system.search("change the model without downtime", top_k=1)
+    assert 'Shadow columns' in results[0]['content']
+
 @pytest.mark.asyncio
 async def test_generate_response(rag_system):
     """Test response generation"""
@@ -167,6 +523,65 @@ async def test_generate_response(rag_system):
     assert isinstance(response, str)
     assert len(response) > 0
 
+def test_int8_embedding_parity():
+    """Test that the int8 backend stays close to fp32 embeddings"""
+    rag = PostgresRAG(
+        db_config=TEST_DB_CONFIG,
+        embedding_model_name='all-MiniLM-L6-v2',
+        llm_model_name='gpt2',
+        inference_backend='torch-int8'
+    )
+    
+    parity = rag.check_embedding_parity(min_cosine=0.95)
+    
+    assert parity['backend'] == 'torch-int8'
+    assert parity['passed']
+
+@pytest.mark.asyncio
+async def test_prefix_kv_cache(rag_system):
+    """Test that the prompt prefix KV state is reused across generations"""
+    context = [{'content': 'pgvector adds vector search to PostgreSQL.', 'metadata': {}, 'similarity': 0.9}]
+    saved_before = rag_system.metrics['prefill_tokens_saved']
+    
+    for _ in range(2):
+        response = rag_system.generate_response("What is pgvector?", context, max_length=100)
+        assert isinstance(response, str)
+    
+    prefix_tokens = len(rag_system.tokenizer(PROMPT_PREFIX).input_ids)
+    assert rag_system.metrics['prefill_tokens_saved'] - saved_before == 2 * prefix_tokens
+
+def test_context_merges_and_deduplicates():
+    """Test merging of overlapping chunks and near-duplicate removal"""
+    text = "PostgreSQL supports vector search. " * 40
+    chunks = PostgresRAG.chunk_text(None, text, chunk_size=300, overlap=60)
+    embedding = np.ones(4, dtype=np.float32)
+    
+    context = [
+        {
+            'id': idx,
+            'content': chunk,
+            'metadata': {'source_doc_id': 'doc-1', 'chunk_index': idx},
+            'similarity': 0.9 - idx * 0.01,
+            'embedding': embedding
+        }
+        for idx, chunk in enumerate(chunks[:2])
+    ]
+    context.append({
+        'id': 99,
+        'content': 'A near copy of the first chunk.',
+        'metadata': {},
+        'similarity': 0.5,
+        'embedding': embedding
+    })
+    
+    merged = PostgresRAG._merge_adjacent_chunks(context)
+    assert len(merged) == 2
+    assert merged[0]['merged_ids'] == [0, 1]
+    assert len(merged[0]['content']) < len(chunks[0]) + len(chunks[1])
+    
+    diverse = PostgresRAG._select_diverse(merged, duplicate_threshold=0.95, mmr_lambda=0.7)
+    assert [doc['id'] for doc in diverse] == [0]
+
 @pytest.mark.asyncio
 async def test_full_query_pipeline(rag_system, clean_database):
     """Test complete RAG pipeline"""
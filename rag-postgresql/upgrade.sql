@@ -0,0 +1,124 @@
+-- Upgrade a database created by an earlier init.sql to the current schema.
+-- init.sql only runs on a fresh volume; existing deployments run this once:
+--   psql -h localhost -U raguser -d ragdb -f upgrade.sql
+-- It is safe to re-run. Converting documents to a partitioned table copies
+-- every row, and writes to documents are blocked while it runs.
+
+BEGIN;
+
+-- Registry of collections and their partitions
+CREATE TABLE IF NOT EXISTS collections (
+    name TEXT PRIMARY KEY,
+    partition_name TEXT UNIQUE NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO collections (name, partition_name) VALUES ('default', 'documents_default')
+ON CONFLICT (name) DO NOTHING;
+
+-- Move a plain documents table into the 'default' partition of a table
+-- partitioned by collection, keeping ids, the id sequence and the
+-- embedding column's type
+DO $$
+DECLARE
+    embedding_type TEXT;
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'documents'::regclass) = 'r' THEN
+        LOCK TABLE documents IN EXCLUSIVE MODE;
+
+        ALTER TABLE documents RENAME TO documents_unpartitioned;
+        ALTER TABLE documents_unpartitioned RENAME CONSTRAINT documents_pkey TO documents_unpartitioned_pkey;
+        DROP INDEX IF EXISTS idx_documents_embedding;
+        DROP INDEX IF EXISTS idx_documents_metadata;
+
+        SELECT format_type(atttypid, atttypmod) INTO embedding_type
+        FROM pg_attribute
+        WHERE attrelid = 'documents_unpartitioned'::regclass AND attname = 'embedding';
+
+        EXECUTE format(
+            'CREATE TABLE documents (
+                id INTEGER NOT NULL DEFAULT nextval(''documents_id_seq''),
+                collection TEXT NOT NULL DEFAULT ''default'',
+                content TEXT NOT NULL,
+                embedding %s,
+                metadata JSONB DEFAULT ''{}'',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (collection, id)
+            ) PARTITION BY LIST (collection)',
+            embedding_type
+        );
+        ALTER SEQUENCE documents_id_seq OWNED BY documents.id;
+        CREATE TABLE documents_default PARTITION OF documents FOR VALUES IN ('default');
+
+        INSERT INTO documents (id, collection, content, embedding, metadata, created_at, updated_at)
+        SELECT id, 'default', content, embedding, metadata, created_at, updated_at
+        FROM documents_unpartitioned;
+        DROP TABLE documents_unpartitioned;
+
+        -- Indexes are built after the copy, so IVFFlat trains on the real data
+        CREATE INDEX idx_documents_default_embedding ON documents_default
+        USING ivfflat (embedding vector_cosine_ops)
+        WITH (lists = 100);
+        CREATE INDEX idx_documents_metadata ON documents USING GIN (metadata);
+        CREATE TRIGGER update_documents_updated_at BEFORE UPDATE
+            ON documents FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
+    END IF;
+END $$;
+
+-- Partial ANN indexes built for hot metadata filters
+CREATE TABLE IF NOT EXISTS filtered_indexes (
+    id SERIAL PRIMARY KEY,
+    collection TEXT NOT NULL REFERENCES collections(name),
+    filter JSONB NOT NULL,
+    index_name TEXT UNIQUE NOT NULL,
+    predicate TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- search_history embeddings are analytics only, half precision is enough
+DO $$
+DECLARE
+    dimension INTEGER;
+BEGIN
+    SELECT atttypmod INTO dimension
+    FROM pg_attribute
+    WHERE attrelid = 'search_history'::regclass
+      AND attname = 'query_embedding'
+      AND atttypid = 'vector'::regtype;
+
+    IF dimension IS NOT NULL THEN
+        EXECUTE format(
+            'ALTER TABLE search_history ALTER COLUMN query_embedding TYPE halfvec(%s) USING query_embedding::halfvec(%s)',
+            dimension, dimension
+        );
+    END IF;
+END $$;
+
+CREATE INDEX IF NOT EXISTS idx_search_history_created ON search_history(created_at);
+
+-- Embedding model the stored vectors come from. Left empty here: the first
+-- worker to connect records the model it was started with.
+CREATE TABLE IF NOT EXISTS embedding_model (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    name TEXT NOT NULL,
+    dimension INTEGER NOT NULL,
+    generation INTEGER NOT NULL DEFAULT 1,
+    switched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Progress of re-embedding jobs
+CREATE TABLE IF NOT EXISTS reembed_jobs (
+    id SERIAL PRIMARY KEY,
+    embedding_model TEXT NOT NULL,
+    state TEXT NOT NULL,
+    rows_total BIGINT,
+    rows_done BIGINT NOT NULL DEFAULT 0,
+    rows_per_second REAL NOT NULL DEFAULT 0,
+    failed_while TEXT,
+    error TEXT,
+    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMIT;
@@ -0,0 +1,166 @@
+import os
+import re
+
+import pytest
+from PyPDF2 import PageObject, PdfWriter
+from PyPDF2.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+from pdf_to_text_summarizer import (
+    find_chapters,
+    iter_pdf_pages,
+    split_chapters_file,
+    split_into_chapters,
+    summarize_chapters,
+    write_pdf_text,
+)
+
+SAMPLE_TEXT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "texto_completo.txt")
+
+SYNTHETIC_TEXT = "\n".join([
+    "Introducción sin encabezado.",
+    "CAPÍTULO 1 Origen del agua",
+    "El agua subterránea se acumula en acuíferos.",
+    "  Capitulo II: Modelos",
+    "Texto del segundo capítulo con acentos: ñandú, canción.",
+    "cap. 3",
+    "SECCIÓN IV Resultados",
+    "1. Objetivo principal",
+    "IV. Conclusión",
+    "1.5 no es un encabezado",
+    "iv. tampoco",
+    "Última línea",
+])
+
+
+def legacy_find_chapters(text):
+    """Line-based chapter detection as it was before the single-regex rewrite"""
+    chapter_patterns = [
+        r'(?i)(?:CAPÍTULO|CAPITULO|CAP\.?)\s*(\d+|[IVX]+)',
+        r'(?i)(?:SECCIÓN|SECCION)\s*(\d+|[IVX]+)',
+        r'^\d+\.\s+[A-Z]',
+        r'^[IVX]+\.\s+[A-Z]'
+    ]
+
+    chapters = []
+    for i, line in enumerate(text.split('\n')):
+        for pattern in chapter_patterns:
+            if re.match(pattern, line.strip()):
+                chapters.append((i, line.strip()))
+                break
+    return chapters
+
+
+def legacy_split_into_chapters(text, chapter_markers):
+    """Line-based chapter split as it was before the single-regex rewrite"""
+    if not chapter_markers:
+        return {"Documento Completo": text}
+
+    chapters = {}
+    lines = text.split('\n')
+    for i, (line_num, chapter_title) in enumerate(chapter_markers):
+        end = chapter_markers[i+1][0] if i+1 < len(chapter_markers) else len(lines)
+        chapters[chapter_title] = '\n'.join(lines[line_num:end])
+    return chapters
+
+
+@pytest.mark.parametrize("source", ["synthetic", "sample"])
+def test_chapters_match_line_based_split(tmp_path, source):
+    """Test that titles and texts are those of the old line-based split"""
+    if source == "synthetic":
+        text = SYNTHETIC_TEXT
+    else:
+        with open(SAMPLE_TEXT, encoding="utf-8") as f:
+            text = f.read()
+
+    expected = legacy_split_into_chapters(text, legacy_find_chapters(text))
+    assert len(expected) > 1
+
+    chapters = split_into_chapters(text, find_chapters(text))
+    assert list(chapters) == list(expected)
+    assert chapters == expected
+
+    path = tmp_path / "text.txt"
+    path.write_bytes(text.encode("utf-8"))
+    assert split_chapters_file(str(path)) == expected
+
+
+def test_text_without_chapters_is_one_document(tmp_path):
+    """Test the single-chapter fallback, for empty files too"""
+    text = "Un texto sin encabezados.\nNi capítulos ni secciones."
+    assert split_into_chapters(text, find_chapters(text)) == {"Documento Completo": text}
+
+    path = tmp_path / "empty.txt"
+    path.write_bytes(b"")
+    assert split_chapters_file(str(path)) == {"Documento Completo": ""}
+
+
+def test_summary_keeps_sentence_order():
+    """Test that the chosen sentences keep their order in the source text"""
+    sentences = [f"Oración de relleno número {i} sin nada especial aquí" for i in range(12)]
+    sentences[3] = "El objetivo principal es proteger el agua subterránea importante"
+    sentences[9] = "La conclusión y el resultado principal del modelo de agua"
+    text = ". ".join(sentences) + "."
+
+    summary, = summarize_chapters([text], max_sentences=3)
+    chosen = [s.strip() for s in summary.rstrip('.').split('. ')]
+
+    assert len(chosen) == 3
+    assert sentences[3] in chosen and sentences[9] in chosen
+    positions = [sentences.index(s) for s in chosen]
+    assert positions == sorted(positions)
+
+
+def test_summaries_are_per_text_across_batches():
+    """Test that batching does not mix sentences of different texts"""
+    texts = [f"Primera oración del texto número {i}. Segunda oración del texto número {i}." for i in range(5)]
+    summaries = summarize_chapters(texts, max_sentences=5, batch_size=2)
+    assert summaries == texts
+
+
+def make_pdf(path, page_texts):
+    """Write a PDF with one line of Helvetica text per page"""
+    font = DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+        NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+    })
+    writer = PdfWriter()
+    for text in page_texts:
+        page = PageObject.create_blank_page(width=612, height=792)
+        content = DecodedStreamObject()
+        content.set_data(f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode("cp1252"))
+        page[NameObject("/Contents")] = content
+        page[NameObject("/Resources")] = DictionaryObject({
+            NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})
+        })
+        writer.add_page(page)
+    with open(path, "wb") as f:
+        writer.write(f)
+
+
+def test_parallel_extraction_keeps_page_order(tmp_path):
+    """Test that pages extracted by several workers come back in order"""
+    page_texts = [f"Página {i} del acuífero, canción número {i}" for i in range(7)]
+    pdf_path = str(tmp_path / "doc.pdf")
+    make_pdf(pdf_path, page_texts)
+
+    pages = list(iter_pdf_pages(pdf_path, workers=2, pages_per_task=1))
+    assert pages == list(enumerate(page_texts))
+    assert list(iter_pdf_pages(pdf_path, workers=1, pages_per_task=3)) == pages
+
+
+def test_page_offsets_slice_back_to_page_text(tmp_path):
+    """Test that write_pdf_text offsets delimit each page's text in the output"""
+    # More pages than one task takes, so several workers extract them
+    page_texts = [f"Página {i}: año, niño y corazón" for i in range(40)]
+    pdf_path = str(tmp_path / "doc.pdf")
+    make_pdf(pdf_path, page_texts)
+
+    output_path = tmp_path / "doc.txt"
+    offsets = write_pdf_text(pdf_path, str(output_path), workers=2)
+    data = output_path.read_bytes()
+
+    assert [entry["page"] for entry in offsets] == list(range(1, 41))
+    assert [data[entry["start"]:entry["end"]].decode("utf-8") for entry in offsets] == page_texts
+    assert offsets[-1]["end"] == len(data)